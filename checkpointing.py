@@ -0,0 +1,204 @@
+import os
+import json
+import mmap
+import random
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def snapshot(obj, memo=None):
+    """Copy every tensor in a (nested) state dict to host memory, detached from training.
+    Tensors reached more than once (memo, keyed by id) are copied once."""
+    memo = {} if memo is None else memo
+    if isinstance(obj, torch.Tensor):
+        if id(obj) not in memo:
+            memo[id(obj)] = obj.detach().to('cpu', copy=True)
+        return memo[id(obj)]
+    if isinstance(obj, dict):
+        return {k: snapshot(v, memo) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v, memo) for v in obj)
+    return obj
+
+
+def strip_module(state):
+    # checkpoints saved from the DDP wrapper carry a 'module.' prefix
+    return {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state.items()}
+
+
+def rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def gather_rng_states():
+    """Every rank's RNG state, in rank order (collective when a process group is up)."""
+    state = rng_state()
+    if not dist.is_initialized():
+        return [state]
+    states = [None] * dist.get_world_size()
+    dist.all_gather_object(states, state)
+    return states
+
+
+def atomic_save(obj, path):
+    # write next to the target and rename: a crash never leaves a truncated checkpoint
+    tmp = path + '.tmp'
+    torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+
+class AsyncCheckpointer(object):
+    """
+    save() snapshots the states to host memory on the calling thread and writes them
+    on a background thread (torch.save + atomic rename), so training continues while
+    the file is written. At most one save is in flight: the next save() waits for it
+    and re-raises its error. on_saved is called on the writer thread once every file
+    is in place. Only rank 0 should hold one.
+    """
+    def __init__(self):
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+    def wait(self):
+        if self.future is not None:
+            future, self.future = self.future, None
+            future.result()
+
+    def save(self, files, on_saved=None):
+        # files: {path: state}
+        self.wait()
+        # one host copy of each tensor, however many files it goes to
+        memo = {}
+        files = {path: snapshot(state, memo) for path, state in files.items()}
+        self.future = self.pool.submit(self._write, files, on_saved)
+
+    @staticmethod
+    def _write(files, on_saved=None):
+        for path, state in files.items():
+            atomic_save(state, path)
+            print("[INFO] Successfully saved " + path)
+        if on_saved is not None:
+            on_saved()
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown(wait=True)
+
+
+def load_resume(path, rank=0):
+    """
+    Rank 0 reads the resume state and broadcasts it to every rank, then each rank
+    restores its own RNG stream. Returns the state dict, or None if there is none.
+    """
+    state = None
+    if rank == 0 and os.path.isfile(path):
+        state = torch.load(path, map_location='cpu', weights_only=False)
+    if dist.is_initialized():
+        holder = [state]
+        # NCCL sends it through the current CUDA device, set in setup()
+        dist.broadcast_object_list(holder, src=0)
+        state = holder[0]
+    if state is None:
+        return None
+    rng = state['rng']
+    world_size = dist.get_world_size() if dist.is_initialized() else 1
+    # a run resumed on a different number of ranks keeps rank 0's stream everywhere
+    set_rng_state(rng[rank] if len(rng) == world_size else rng[0])
+    return state
+
+
+# safetensors layout (readable by the safetensors package, written without it): an
+# 8-byte little-endian header size, a JSON header {name: {dtype, shape, data_offsets}}
+# with string metadata under "__metadata__", then the raw tensor bytes.
+SAFETENSORS_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8,
+    'U8': torch.uint8, 'BOOL': torch.bool,
+}
+SAFETENSORS_NAMES = {v: k for k, v in SAFETENSORS_DTYPES.items()}
+
+
+def save_safetensors(state, path, metadata=None):
+    """Write a prefix-free state dict and string metadata as a .safetensors file (atomic rename)."""
+    state = {k: v.detach().to('cpu').contiguous() for k, v in strip_module(state).items()}
+    # widest dtypes first: with the 8-byte aligned header every tensor starts aligned
+    names = sorted(state, key=lambda k: (-state[k].element_size(), k))
+    header, offset = {}, 0
+    for k in names:
+        size = state[k].numel() * state[k].element_size()
+        header[k] = {'dtype': SAFETENSORS_NAMES[state[k].dtype], 'shape': list(state[k].shape),
+                     'data_offsets': [offset, offset + size]}
+        offset += size
+    if metadata:
+        header['__metadata__'] = {k: str(v) for k, v in metadata.items()}
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for k in names:
+            f.write(state[k].reshape(-1).view(torch.uint8).numpy().tobytes())
+    os.replace(tmp, path)
+
+
+def load_safetensors(path):
+    """
+    (state dict, metadata) of a .safetensors file. The tensors are views into a private
+    (copy-on-write) mmap of the file, so pages are only read when a tensor is touched.
+    """
+    with open(path, 'rb') as f:
+        size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(size))
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    metadata = header.pop('__metadata__', {})
+    state = {}
+    for k, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info['dtype']]
+        lo, hi = info['data_offsets']
+        numel = (hi - lo) // dtype.itemsize
+        if numel == 0:
+            state[k] = torch.empty(info['shape'], dtype=dtype)
+        else:
+            state[k] = torch.frombuffer(buf, dtype=dtype, count=numel, offset=8 + size + lo).view(info['shape'])
+    return state, metadata
+
+
+def load_weights(path):
+    """(state dict without 'module.' prefixes, metadata) of a .safetensors export or a .pth checkpoint."""
+    if path.endswith('.safetensors'):
+        return load_safetensors(path)
+    return strip_module(torch.load(path, map_location='cpu', mmap=True)), {}
+
+
+def load_checkpoint(net, path, **expected):
+    """
+    Strictly load a checkpoint into net: missing or unexpected keys raise, and so
+    does any metadata entry (block_num, task, ...) that differs from `expected`.
+    """
+    state, metadata = load_weights(path)
+    for k, v in expected.items():
+        if k in metadata and metadata[k] != str(v):
+            raise ValueError("{}: {} is {}, expected {}".format(path, k, metadata[k], v))
+    net.load_state_dict(state)
+    return metadata
@@ -12,6 +12,7 @@ def get_arguments():
     parser.add_argument("--task", type=str, default="1to1", help="task of this training")
     parser.add_argument("--batch_size", type=int, default=BATCH_SIZE, help="Batch size for training. ")
     parser.add_argument("--weight", type=float, default=1, help="Weight for forward loss. ")
+    parser.add_argument("--store", type=str, default=None, help="Packed slice store (dataset/slice_store.py), replaces root1/2/3 reading. ")
     
     
     return parser
@@ -16,6 +16,8 @@ import cv2
 
 import matplotlib.pyplot as plt
 
+from .slice_store import SliceStore
+
 
 def generate_mask(img_height,img_width,radius,center_x,center_y):
     y,x=np.ogrid[0:img_height,0:img_width]
@@ -23,10 +25,20 @@ def generate_mask(img_height,img_width,radius,center_x,center_y):
     mask = (x-center_x)**2+(y-center_y)**2<=radius**2
     return mask
 
+def slice_mask(h, w):
+    # the one field-of-view mask of the dataset, used by the .mat path and when packing a store
+    return generate_mask(h, w, 128, 128, 128)
+
 class mriDataset(Dataset):
     def __init__(self, opt,root1,root2,root3): 
     
         self.task = opt.task
+        self.store = None
+        if opt.store:
+            # packed slices, see dataset/slice_store.py
+            self.store = SliceStore(opt.store)
+            return
+
         input_2 = np.array([root2 +"/"+ x  for x in os.listdir(root2)])
         target_forward = np.array([root1 +"/"+ x  for x in os.listdir(root1)])
         input_3 = np.array([root3 +"/"+ x  for x in os.listdir(root3)])
@@ -39,13 +51,15 @@ class mriDataset(Dataset):
 
         self.data = {'input_2':input_2, 'target_forward':target_forward,'input_3':input_3}
             
-    def np2tensor(self, array):
-        return torch.Tensor(array).permute(2,0,1)
-
     def __len__(self):
+        if self.store is not None:
+            return len(self.store)
         return len(self.data['target_forward'])
 
     def __getitem__(self, idx):        
+        if self.store is not None:
+            return self.get_stored(idx)
+
         input_2_path = self.data['input_2'][idx]
         target_forward_path = self.data['target_forward'][idx]
         input_3_path = self.data['input_3'][idx]
@@ -55,40 +69,41 @@ class mriDataset(Dataset):
         input_2_data = io.loadmat(input_2_path)['img']
         target_forward_data = io.loadmat(target_forward_path)['img']
         
-        mask = generate_mask(256, 256, 128, 128, 128)
-            
-        input_2_data = input_2_data * mask
-        target_forward_data = target_forward_data * mask
-        
-        h,w = input_2_data.shape
-
-        target_forward_img = np.expand_dims(target_forward_data, 2) 
-        target_forward_img = np.concatenate((target_forward_img,target_forward_img,target_forward_img),axis=2)
-
-        input_2_img = np.expand_dims(input_2_data, 2) 
-        input_img = np.zeros((h,w,3))
-                           
-        if self.task== '1to1':                      
-            input_img[:,:,0] = input_2_img[:,:,0]
-            input_img[:,:,1] = input_2_img[:,:,0]
-            input_img[:,:,2] = input_2_img[:,:,0]
-        else:
+        if self.task != '1to1':
             assert 0
 
-        input_target_img = input_img.copy()
-
-        input_img = self.np2tensor(input_img).float()
-        target_forward_img = self.np2tensor(target_forward_img).float()
-        input_target_img = self.np2tensor(input_target_img).float()
+        h,w = input_2_data.shape
+        mask = slice_mask(h, w)
+            
+        # 1-channel float32, the 3-channel variable augmentation is done on device (model.variable_augment)
+        input_img = torch.from_numpy((input_2_data * mask).astype(np.float32)).unsqueeze(0)
+        target_forward_img = torch.from_numpy((target_forward_data * mask).astype(np.float32)).unsqueeze(0)
 
         sample = {
             'input_img': input_img, 
             'target_forward_img': target_forward_img, 
-            'input_target_img': input_target_img,
             'input2_name': input_2_path.split("/")[-1].split(".")[0],
             'input3_name': input_3_path.split("/")[-1].split(".")[0],
             'target_forward_name': target_forward_path.split("/")[-1].split(".")[0]
         }
         return sample
 
+    def get_stored(self, idx):
+        assert self.task == '1to1'
+        input_2_name, input_3_name, target_forward_name = self.store.names(idx)
+        input_2_data, target_forward_data = self.store.pair(idx)
+
+        # views of the memmap (float16 stores are upcast here)
+        input_img = torch.from_numpy(input_2_data).float().unsqueeze(0)
+        target_forward_img = torch.from_numpy(target_forward_data).float().unsqueeze(0)
+
+        sample = {
+            'input_img': input_img,
+            'target_forward_img': target_forward_img,
+            'input2_name': input_2_name,
+            'input3_name': input_3_name,
+            'target_forward_name': target_forward_name
+        }
+        return sample
+
 
@@ -0,0 +1,63 @@
+import torch
+from torch.utils.data import DataLoader
+
+
+def decode_all(dataset, device='cpu', batch_size=64):
+    """
+    Decode a whole mriDataset once: {'input_img', 'target_forward_img'} as [N,1,H,W]
+    float32 tensors on device, plus the name lists.
+    """
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=0, drop_last=False)
+    inputs, targets = [], []
+    data = {'input2_name': [], 'input3_name': [], 'target_forward_name': []}
+    for sample_batched in loader:
+        inputs.append(sample_batched['input_img'])
+        targets.append(sample_batched['target_forward_img'])
+        for k in data:
+            data[k].extend(sample_batched[k])
+    data['input_img'] = torch.cat(inputs).to(device)
+    data['target_forward_img'] = torch.cat(targets).to(device)
+    return data
+
+
+class ResidentLoader(object):
+    """
+    DataLoader stand-in over decode_all() tensors: batches are gathered by index on the
+    tensors' device, no workers, no collation. With a (Distributed)Sampler the indices,
+    shuffling and sharding come from it, otherwise every epoch is a fresh permutation.
+    """
+    def __init__(self, data, batch_size=1, sampler=None, shuffle=True, drop_last=True):
+        self.data = data
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num = data['input_img'].size(0)
+
+    def indices(self):
+        if self.sampler is not None:
+            return torch.as_tensor(list(self.sampler), dtype=torch.long)
+        if self.shuffle:
+            return torch.randperm(self.num)
+        return torch.arange(self.num)
+
+    def __len__(self):
+        num = len(self.sampler) if self.sampler is not None else self.num
+        if self.drop_last:
+            return num // self.batch_size
+        return (num + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        device = self.data['input_img'].device
+        indices = self.indices()
+        for i in range(len(self)):
+            idx = indices[i * self.batch_size:(i + 1) * self.batch_size]
+            names = idx.tolist()
+            idx = idx.to(device)
+            yield {
+                'input_img': self.data['input_img'].index_select(0, idx),
+                'target_forward_img': self.data['target_forward_img'].index_select(0, idx),
+                'input2_name': [self.data['input2_name'][j] for j in names],
+                'input3_name': [self.data['input3_name'][j] for j in names],
+                'target_forward_name': [self.data['target_forward_name'][j] for j in names],
+            }
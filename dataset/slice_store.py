@@ -0,0 +1,110 @@
+import os, json
+import argparse
+
+import numpy as np
+import scipy.io as io
+
+
+# 2: packed with mri_dataset.slice_mask (version 1 stores used a size-dependent mask)
+STORE_VERSION = 2
+
+
+def store_paths(path):
+    # store "foo" -> foo.npy (slices) + foo.json (sidecar index)
+    base = path[:-4] if path.endswith('.npy') else path
+    return base + '.npy', base + '.json'
+
+
+def list_pairs(root1, root2, root3):
+    input_2 = sorted(os.listdir(root2))
+    target_forward = sorted(os.listdir(root1))
+    input_3 = sorted(os.listdir(root3))
+
+    assert len(input_2) == len(target_forward) == len(input_3)
+    for a, b, c in zip(input_2, target_forward, input_3):
+        assert a == b == c, "unpaired slice: %s %s %s" % (a, b, c)
+
+    return input_2, target_forward, input_3
+
+
+def pack_slices(root1, root2, root3, out, dtype='float32', mask_fn=None):
+    """
+    Decode every PET/CT .mat pair once into a contiguous [N, 2, H, W] array
+    (channel 0: PET input, channel 1: CT target) plus a json sidecar index.
+    """
+    input_2, target_forward, input_3 = list_pairs(root1, root2, root3)
+    data_path, index_path = store_paths(out)
+    os.makedirs(os.path.dirname(os.path.abspath(data_path)), exist_ok=True)
+
+    first = io.loadmat(os.path.join(root2, input_2[0]))['img']
+    h, w = first.shape
+    mask = mask_fn(h, w) if mask_fn is not None else None
+
+    slices = np.lib.format.open_memmap(data_path, mode='w+', dtype=np.dtype(dtype), shape=(len(input_2), 2, h, w))
+    for i, name in enumerate(input_2):
+        pet = io.loadmat(os.path.join(root2, name))['img']
+        ct = io.loadmat(os.path.join(root1, target_forward[i]))['img']
+        if mask is not None:
+            pet = pet * mask
+            ct = ct * mask
+        slices[i, 0] = pet
+        slices[i, 1] = ct
+    slices.flush()
+    del slices
+
+    index = {
+        'version': STORE_VERSION,
+        'shape': [len(input_2), 2, h, w],
+        'dtype': np.dtype(dtype).name,
+        'masked': mask is not None,
+        'roots': {'root1': root1, 'root2': root2, 'root3': root3},
+        'input2_name': [x.split(".")[0] for x in input_2],
+        'input3_name': [x.split(".")[0] for x in input_3],
+        'target_forward_name': [x.split(".")[0] for x in target_forward],
+    }
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+
+    return data_path, index_path
+
+
+class SliceStore(object):
+    """Read side of a packed store; slices are served as views of one memmap."""
+
+    def __init__(self, path):
+        data_path, index_path = store_paths(path)
+        with open(index_path) as f:
+            self.index = json.load(f)
+        assert self.index['version'] == STORE_VERSION, "unsupported store version, repack with dataset/slice_store.py"
+        # slices are served as packed: an unmasked store would differ from the .mat path
+        assert self.index['masked'], "store was packed without the slice mask, repack with dataset/slice_store.py"
+        # copy-on-write so torch.from_numpy gets a writable view without touching the file
+        self.slices = np.load(data_path, mmap_mode='c')
+        assert list(self.slices.shape) == self.index['shape']
+
+    def __len__(self):
+        return self.slices.shape[0]
+
+    def names(self, idx):
+        return (self.index['input2_name'][idx], self.index['input3_name'][idx],
+                self.index['target_forward_name'][idx])
+
+    def pair(self, idx):
+        # zero-copy [H, W] views: PET input, CT target
+        return self.slices[idx, 0], self.slices[idx, 1]
+
+
+if __name__ == '__main__':
+    from dataset.mri_dataset import slice_mask
+
+    parser = argparse.ArgumentParser(description="pack PET/CT .mat slices into a memory-mapped store")
+    parser.add_argument("--root1", type=str, required=True, help="Output images. ")
+    parser.add_argument("--root2", type=str, required=True, help="Input images. ")
+    parser.add_argument("--root3", type=str, required=True, help="Another input images. ")
+    parser.add_argument("--out", type=str, required=True, help="Store path (writes <out>.npy and <out>.json). ")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16"], help="Storage dtype. ")
+    args = parser.parse_args()
+
+    data_path, index_path = pack_slices(args.root1, args.root2, args.root3, args.out, args.dtype,
+                                        mask_fn=slice_mask)
+    print("[INFO] packed %s + %s" % (data_path, index_path))
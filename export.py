@@ -0,0 +1,144 @@
+import os
+import copy
+import argparse
+import warnings
+from typing import Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model.model import InvISPNet, InvISPReverse, subnet
+from model.modules import InvertibleConv1x1
+from checkpointing import save_safetensors, load_checkpoint
+
+
+# Ahead-of-time export: the forward (PET -> CT) and reverse mappings as two frozen
+# TorchScript graphs (forward.pt / reverse.pt) and / or two ONNX graphs (forward.onnx /
+# reverse.onnx), so deployment loads a precompiled graph instead of the model code.
+# weights.safetensors is the prefix-free, memory-mappable weight file for eager inference.
+
+def build(ckpt, block_num=8, fuse_gh=False):
+    net = InvISPNet(channel_in=3, channel_out=3, subnet_constructor=subnet('DBNet'), block_num=block_num, fuse_gh=fuse_gh)
+    # strict: a checkpoint of another architecture fails here instead of exporting random weights
+    load_checkpoint(net, ckpt, block_num=block_num, channel_in=3, channel_out=3)
+    return net.eval()
+
+
+def export_weights(net, out_path, task='1to1'):
+    os.makedirs(out_path, exist_ok=True)
+    path = os.path.join(out_path, 'weights.safetensors')
+    metadata = {'block_num': len(net.operations), 'channel_in': 3, 'channel_out': 3, 'task': task}
+    save_safetensors(net.state_dict(), path, metadata)
+    return path
+
+
+def export_torchscript(net, out_path):
+    os.makedirs(out_path, exist_ok=True)
+    paths = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        for name, module in (('forward', net), ('reverse', InvISPReverse(net))):
+            scripted = torch.jit.script(module.eval())
+            # weights (and the composed 1x1 flow weights) become constants of the graph
+            frozen = torch.jit.freeze(scripted)
+            paths[name] = os.path.join(out_path, name + '.pt')
+            frozen.save(paths[name])
+    return paths
+
+
+class BakedConv1x1(nn.Module):
+    """InvertibleConv1x1 with W = PLU and W^-1 precomputed as constants (ONNX has no triangular solve)."""
+    def __init__(self, invconv):
+        super(BakedConv1x1, self).__init__()
+        with torch.no_grad():
+            weight, weight_inv, _ = invconv.cached_weight()
+        c = weight.size(0)
+        self.register_buffer('weight', weight.view(c, c, 1, 1).clone())
+        self.register_buffer('weight_inv', weight_inv.view(c, c, 1, 1).clone())
+
+    def forward(self, input, logdet: Optional[torch.Tensor] = None, reverse: bool = False):
+        return F.conv2d(input, self.weight_inv if reverse else self.weight), logdet
+
+
+def bake(net):
+    # a copy of the net whose 1x1 flow convs are constants
+    net = copy.deepcopy(net).eval()
+    for op in net.operations:
+        if isinstance(op.invconv, InvertibleConv1x1):
+            op.invconv = BakedConv1x1(op.invconv)
+    return net
+
+
+def export_onnx(net, out_path, size=256, opset=None):
+    # batch, height and width stay dynamic
+    net = bake(net)
+    os.makedirs(out_path, exist_ok=True)
+    x = torch.rand(1, 3, size, size)
+    axes = {0: 'batch', 2: 'height', 3: 'width'}
+    paths = {}
+    with warnings.catch_warnings(), torch.no_grad():
+        warnings.simplefilter('ignore')
+        for name, module in (('forward', net), ('reverse', InvISPReverse(net))):
+            paths[name] = os.path.join(out_path, name + '.onnx')
+            torch.onnx.export(module.eval(), (x,), paths[name], input_names=['input'], output_names=['output'],
+                              dynamic_axes={'input': axes, 'output': axes}, opset_version=opset, do_constant_folding=True,
+                              external_data=False)
+    return paths
+
+
+class ExportedNet(object):
+    """
+    forward.pt / reverse.pt loaded back, called like InvISPNet: net(x) and net(x, rev=True).
+    optimize applies torch.jit.optimize_for_inference after loading (its graphs cannot be saved).
+    """
+    def __init__(self, path, device='cpu', optimize=False):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            self.forward_graph = torch.jit.load(os.path.join(path, 'forward.pt'), map_location=device)
+            self.reverse_graph = torch.jit.load(os.path.join(path, 'reverse.pt'), map_location=device)
+            if optimize:
+                self.forward_graph = torch.jit.optimize_for_inference(self.forward_graph)
+                self.reverse_graph = torch.jit.optimize_for_inference(self.reverse_graph)
+
+    def __call__(self, x, rev=False):
+        return self.reverse_graph(x) if rev else self.forward_graph(x)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="export frozen forward / reverse graphs of a checkpoint")
+    parser.add_argument("--ckpt", type=str, required=True, help="Checkpoint path. ")
+    parser.add_argument("--out_path", type=str, default="./results/export/", help="Directory for forward.pt / reverse.pt. ")
+    parser.add_argument("--block_num", type=int, default=8)
+    parser.add_argument("--fuse_gh", dest='fuse_gh', action='store_true', help="Export with the fused G/H subnets. ")
+    parser.add_argument("--format", type=str, default="torchscript", choices=['torchscript', 'onnx', 'safetensors', 'all'], help="Which graphs to write; safetensors writes the weights only. ")
+    parser.add_argument("--task", type=str, default="1to1", help="Task recorded in the safetensors metadata. ")
+    parser.add_argument("--opset", type=int, default=None, help="ONNX opset, default: the exporter's. ")
+    parser.add_argument("--size", type=int, default=256, help="Slice size used for tracing and the consistency check. ")
+    args = parser.parse_args()
+
+    net = build(args.ckpt, args.block_num, args.fuse_gh)
+    exported = {}
+    if args.format in ('torchscript', 'all'):
+        paths = export_torchscript(net, args.out_path)
+        print("[INFO] Exported {}".format(", ".join(paths.values())))
+        exported['torchscript'] = ExportedNet(args.out_path)
+    if args.format in ('onnx', 'all'):
+        from onnx_backend import OnnxNet
+        paths = export_onnx(net, args.out_path, args.size, args.opset)
+        print("[INFO] Exported {}".format(", ".join(paths.values())))
+        exported['onnx'] = OnnxNet(args.out_path)
+    if args.format in ('safetensors', 'all'):
+        path = export_weights(net, args.out_path, args.task)
+        print("[INFO] Exported {}".format(path))
+        exported['safetensors'] = build(path, args.block_num, args.fuse_gh)
+
+    # the exported graphs must reproduce the eager model
+    x = torch.rand(1, 3, args.size, args.size)
+    with torch.inference_mode():
+        y = torch.clamp(net(x), 0, 1)
+        y_rev = net(y, rev=True)
+        for name, graphs in exported.items():
+            err_for = (torch.clamp(graphs(x), 0, 1) - y).abs().max().item()
+            err_rev = (graphs(y, rev=True) - y_rev).abs().max().item()
+            print("[INFO] {}: max |exported - eager|: forward {:.3g}  reverse {:.3g}".format(name, err_for, err_rev))
@@ -0,0 +1,248 @@
+import csv
+import json
+import math
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+
+# Batched image metrics on [N,H,W] (or [N,1,H,W]) tensors, computed on the tensors' device.
+# Each function returns one value per slice, matching skimage.metrics on every slice.
+
+def _flat(x, dtype):
+    if x.dim() == 4:
+        x = x[:, 0]
+    return x.to(dtype)
+
+def mse(target, pred, dtype=torch.float64):
+    target, pred = _flat(target, dtype), _flat(pred, dtype)
+    return ((target - pred) ** 2).mean(dim=(-2, -1))
+
+def rmse(target, pred, dtype=torch.float64):
+    return torch.sqrt(mse(target, pred, dtype))
+
+def nmse(target, pred, dtype=torch.float64):
+    target, pred = _flat(target, dtype), _flat(pred, dtype)
+    return ((pred - target) ** 2).sum(dim=(-2, -1)) / (target ** 2).sum(dim=(-2, -1))
+
+def psnr(target, pred, data_range=1., dtype=torch.float64):
+    return 10 * torch.log10((data_range ** 2) / mse(target, pred, dtype))
+
+def _window(win_size, gaussian, sigma, dtype, device):
+    if not gaussian:
+        return torch.full((win_size,), 1. / win_size, dtype=dtype, device=device)
+    r = (win_size - 1) // 2
+    x = torch.arange(-r, r + 1, dtype=dtype, device=device)
+    w = torch.exp(-0.5 * (x / sigma) ** 2)
+    return w / w.sum()
+
+def ssim(target, pred, data_range=1., gaussian=False, win_size=None, sigma=1.5, K1=0.01, K2=0.03,
+         use_sample_covariance=True, dtype=torch.float64):
+    """
+    Same definition as skimage.metrics.structural_similarity (defaults: 7x7 box
+    window, sample covariance; gaussian=True gives the 11-tap sigma=1.5 window).
+    The window is applied separably and only at valid positions, which is exactly
+    the region skimage keeps after cropping the filter radius.
+    """
+    target, pred = _flat(target, dtype), _flat(pred, dtype)
+    if win_size is None:
+        win_size = 2 * int(3.5 * sigma + 0.5) + 1 if gaussian else 7
+    n = target.size(0)
+
+    w = _window(win_size, gaussian, sigma, dtype, target.device)
+    stack = torch.cat((target, pred, target * target, pred * pred, target * pred), 0).unsqueeze(1)
+    filtered = F.conv2d(F.conv2d(stack, w.view(1, 1, -1, 1)), w.view(1, 1, 1, -1))
+    ux, uy, uxx, uyy, uxy = filtered[:, 0].split(n, 0)
+
+    cov_norm = win_size ** 2 / (win_size ** 2 - 1) if use_sample_covariance else 1.
+    vx = cov_norm * (uxx - ux * ux)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - ux * uy)
+
+    C1 = (K1 * data_range) ** 2
+    C2 = (K2 * data_range) ** 2
+    S = ((2 * ux * uy + C1) * (2 * vxy + C2)) / ((ux ** 2 + uy ** 2 + C1) * (vx + vy + C2))
+    return S.mean(dim=(-2, -1))
+
+def evaluate(pred_for, target_for, pred_rev=None, target_rev=None):
+    """
+    test.py metrics for a batch of [N,H,W] slices, one [N] tensor per entry.
+    PSNR/SSIM use |x| as test.py always has.
+    """
+    results = {
+        'psnr': psnr(target_for.abs(), pred_for.abs()),
+        'ssim': ssim(target_for.abs(), pred_for.abs()),
+        'mse': mse(target_for, pred_for),
+        'nmse': nmse(target_for, pred_for),
+    }
+    results['rmse'] = torch.sqrt(results['mse'])
+    if pred_rev is not None:
+        results['psnr_rev'] = psnr(target_rev.abs(), pred_rev.abs())
+        results['ssim_rev'] = ssim(target_rev.abs(), pred_rev.abs())
+    return results
+
+
+class P2Quantile(object):
+    """
+    Streaming quantile estimate in constant memory (the P^2 algorithm of Jain &
+    Chlamtac, 1985): five markers whose heights are adjusted with a parabolic fit.
+    """
+    def __init__(self, p):
+        self.p = p
+        self.q = []
+        self.n = [0, 1, 2, 3, 4]
+        self.desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self.step = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        q, n = self.q, self.n
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = max(i for i in range(4) if q[i] <= x)
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.step[i]
+
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                qp = q[i] + d / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                                                        + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < qp < q[i + 1]:
+                    qp = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = qp
+                n[i] += d
+
+    def value(self):
+        if not self.q:
+            return float('nan')
+        if len(self.q) < 5:
+            # exact (linear interpolation) while there are fewer samples than markers
+            pos = self.p * (len(self.q) - 1)
+            lo = int(math.floor(pos))
+            hi = min(lo + 1, len(self.q) - 1)
+            return self.q[lo] + (pos - lo) * (self.q[hi] - self.q[lo])
+        return self.q[2]
+
+
+class RunningStats(object):
+    """Welford mean / variance (population, like np.std) plus min, max and optional P^2 quantiles."""
+    def __init__(self, quantiles=()):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.quantiles = [P2Quantile(p) for p in quantiles]
+
+    def add(self, x):
+        x = float(x)
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+        for q in self.quantiles:
+            q.add(x)
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.count) if self.count else float('nan')
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0, 'mean': float('nan'), 'std': float('nan'), 'min': float('nan'), 'max': float('nan')}
+        out = {'count': self.count, 'mean': self.mean, 'std': self.std, 'min': self.min, 'max': self.max}
+        for q in self.quantiles:
+            out['q%g' % (100 * q.p)] = q.value()
+        return out
+
+
+class MetricAggregator(object):
+    """
+    Streaming per-checkpoint metric aggregation: per-slice rows go straight to a
+    CSV file, only running statistics are kept in memory. NaN marks a metric that
+    was not computed for a slice: it is left out of the statistics and the CSV cell is empty.
+    """
+    def __init__(self, keys, csv_path=None, quantiles=()):
+        self.keys = list(keys)
+        self.stats = {k: RunningStats(quantiles) for k in self.keys}
+        self.csv_file = None
+        if csv_path is not None:
+            self.csv_file = open(csv_path, 'w', newline='')
+            self.csv = csv.writer(self.csv_file)
+            self.csv.writerow(['name'] + self.keys)
+
+    def update(self, names, batch_metrics):
+        # batch_metrics: key -> [N] array-like, names: N slice names
+        columns = [[float(v) for v in batch_metrics[k]] for k in self.keys]
+        for j, name in enumerate(names):
+            row = [c[j] for c in columns]
+            for k, v in zip(self.keys, row):
+                if v == v:
+                    self.stats[k].add(v)
+            if self.csv_file is not None:
+                self.csv.writerow([name] + ['' if v != v else v for v in row])
+
+    def summary(self):
+        return {k: self.stats[k].summary() for k in self.keys}
+
+    def write_json(self, path, **extra):
+        summary = dict(extra)
+        summary['metrics'] = self.summary()
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+    def close(self):
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = None
+
+
+if __name__ == '__main__':
+    # validate against skimage on random slices
+    import numpy as np
+    from skimage.metrics import peak_signal_noise_ratio, structural_similarity, mean_squared_error
+
+    parser = argparse.ArgumentParser(description="check the batched metrics against skimage")
+    parser.add_argument("--num", type=int, default=8)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--tol", type=float, default=1e-6)
+    args = parser.parse_args()
+
+    g = torch.Generator().manual_seed(0)
+    target = torch.rand(args.num, args.size, args.size, generator=g)
+    pred = (target + 0.1 * torch.randn(args.num, args.size, args.size, generator=g)).clamp(0, 1)
+    t, p = target.numpy(), pred.numpy()
+
+    checks = {
+        'psnr': (psnr(target, pred), [peak_signal_noise_ratio(a, b, data_range=1) for a, b in zip(t, p)]),
+        'ssim': (ssim(target, pred), [structural_similarity(a, b, data_range=1) for a, b in zip(t, p)]),
+        'ssim_gaussian': (ssim(target, pred, gaussian=True, use_sample_covariance=False),
+                          [structural_similarity(a, b, data_range=1, gaussian_weights=True, sigma=1.5,
+                                                 use_sample_covariance=False) for a, b in zip(t, p)]),
+        'mse': (mse(target, pred), [mean_squared_error(a, b) for a, b in zip(t, p)]),
+    }
+    failed = False
+    for name, (ours, ref) in checks.items():
+        err = np.abs(ours.numpy() - np.asarray(ref, dtype=np.float64)).max()
+        print("%-14s max |diff| = %.3g" % (name, err))
+        failed = failed or not err <= args.tol * max(1., math.fabs(max(ref)))
+    if failed:
+        raise SystemExit("[ERROR] metrics differ from skimage by more than %g" % args.tol)
+    print("[INFO] metrics match skimage")
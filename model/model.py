@@ -1,13 +1,17 @@
 #原本的，三通道的
 
 import math
+from typing import Tuple
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import torch.nn.init as init
+from torch.utils.checkpoint import checkpoint as checkpoint_fn
 
 from .modules import InvertibleConv1x1
+from .reversible import InvertibleBackprop
 
 
 def initialize_weights(net_l, scale=1):
@@ -50,9 +54,35 @@ def initialize_weights_xavier(net_l, scale=1):
                 init.constant_(m.bias.data, 0.0)
 
 
+class SharedConcat(torch.autograd.Function):
+    """
+    torch.cat((f_1, .., f_k), 1) for features laid out back to back in one
+    preallocated buffer: only f_k is copied in, and the result aliases the first
+    sum(C_i) channels of the buffer (with its own version counter, so later
+    writes into the free channels do not invalidate tensors saved by autograd).
+    The backward just splits the gradient.
+    """
+    @staticmethod
+    def forward(ctx, buf, *feats):
+        ctx.sizes = [f.size(1) for f in feats]
+        width = sum(ctx.sizes)
+        buf[:, width - ctx.sizes[-1]:width].copy_(feats[-1])
+        size = (buf.size(0), width) + tuple(buf.shape[2:])
+        return buf.new_empty(0).set_(buf.untyped_storage(), buf.storage_offset(), size, buf.stride())
+
+    @staticmethod
+    def backward(ctx, grad):
+        return (None,) + tuple(grad.split(ctx.sizes, 1))
+
+
 class DenseBlock(nn.Module):
-    def __init__(self, channel_in, channel_out, init='xavier', gc=32, bias=True):
+    __constants__ = ['memory_efficient']
+
+    def __init__(self, channel_in, channel_out, init='xavier', gc=32, bias=True, memory_efficient=False):
         super(DenseBlock, self).__init__()
+        # grow the features in one shared buffer instead of re-concatenating them for every layer
+        self.memory_efficient = memory_efficient
+        self.gc = gc
         self.conv1 = nn.Conv2d(channel_in, gc, 3, 1, 1, bias=bias)
         self.conv2 = nn.Conv2d(channel_in + gc, gc, 3, 1, 1, bias=bias)
         self.conv3 = nn.Conv2d(channel_in + 2 * gc, gc, 3, 1, 1, bias=bias)
@@ -67,6 +97,9 @@ class DenseBlock(nn.Module):
         initialize_weights(self.conv5, 0)
     
     def forward(self, x):
+        if self.memory_efficient and not torch.jit.is_scripting():
+            return self.forward_shared(x)
+
         x1 = self.lrelu(self.conv1(x))
         x2 = self.lrelu(self.conv2(torch.cat((x, x1), 1)))
         x3 = self.lrelu(self.conv3(torch.cat((x, x1, x2), 1)))
@@ -75,13 +108,136 @@ class DenseBlock(nn.Module):
 
         return x5
 
-def subnet(net_structure, init='xavier'):
+    @torch.jit.unused
+    def forward_shared(self, x):
+        n, c, h, w = x.shape
+        buf = x.new_empty((n, c + 4 * self.gc, h, w))
+        x1 = self.lrelu(self.conv1(SharedConcat.apply(buf, x)))
+        x2 = self.lrelu(self.conv2(SharedConcat.apply(buf, x, x1)))
+        x3 = self.lrelu(self.conv3(SharedConcat.apply(buf, x, x1, x2)))
+        x4 = self.lrelu(self.conv4(SharedConcat.apply(buf, x, x1, x2, x3)))
+        x5 = self.conv5(SharedConcat.apply(buf, x, x1, x2, x3, x4))
+
+        return x5
+
+
+class FusedDenseBlock(nn.Module):
+    """
+    Two DenseBlocks that read the same input (G and H of an InvBlock) evaluated
+    together: conv1 has a shared input, conv2..conv5 are grouped convs (groups=2),
+    so each layer is one conv launch instead of two.
+
+    The features are laid out mirrored, [a_k .. a_1 x | x b_1 .. b_k], so that the
+    input of every layer is one contiguous channel slice of a single buffer. Group 0
+    (the first block) therefore sees its input blocks in reverse order, which is
+    folded into its weights by merge_state/split_state.
+    """
+    def __init__(self, channel_in, channel_out, gc=32, bias=True):
+        super(FusedDenseBlock, self).__init__()
+        self.gc = gc
+        self.channel_in = channel_in
+        self.channel_out = channel_out
+        self.conv1 = nn.Conv2d(channel_in, 2 * gc, 3, 1, 1, bias=bias)
+        self.conv2 = nn.Conv2d(2 * (channel_in + gc), 2 * gc, 3, 1, 1, bias=bias, groups=2)
+        self.conv3 = nn.Conv2d(2 * (channel_in + 2 * gc), 2 * gc, 3, 1, 1, bias=bias, groups=2)
+        self.conv4 = nn.Conv2d(2 * (channel_in + 3 * gc), 2 * gc, 3, 1, 1, bias=bias, groups=2)
+        self.conv5 = nn.Conv2d(2 * (channel_in + 4 * gc), 2 * channel_out, 3, 1, 1, bias=bias, groups=2)
+        self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
+
+    @staticmethod
+    def _mirror(weight, channel_in, gc, reverse=False):
+        # input-channel blocks [x, f_1 .. f_k] -> [f_k .. f_1, x] (reverse=True undoes it)
+        if not reverse:
+            blocks = [weight[:, :channel_in]] + list(weight[:, channel_in:].split(gc, 1))
+        else:
+            blocks = list(weight[:, :-channel_in].split(gc, 1)) + [weight[:, -channel_in:]]
+        return torch.cat(blocks[::-1], 1)
+
+    @staticmethod
+    def merge_state(state_a, state_b):
+        # two DenseBlock state dicts (conv*.weight / conv*.bias) -> fused layout
+        gc, channel_in = state_a['conv1.weight'].shape[:2]
+        state = {}
+        for k in state_a:
+            a = state_a[k]
+            if k.endswith('weight') and not k.startswith('conv1.'):
+                a = FusedDenseBlock._mirror(a, channel_in, gc)
+            state[k] = torch.cat((a, state_b[k]), 0)
+        return state
+
+    @staticmethod
+    def split_state(state):
+        # fused layout -> two DenseBlock state dicts
+        gc, channel_in = state['conv1.weight'].shape[0] // 2, state['conv1.weight'].shape[1]
+        state_a, state_b = {}, {}
+        for k, v in state.items():
+            a, b = v.chunk(2, 0)
+            if k.endswith('weight') and not k.startswith('conv1.'):
+                a = FusedDenseBlock._mirror(a, channel_in, gc, reverse=True)
+            state_a[k], state_b[k] = a.contiguous(), b.contiguous()
+        return state_a, state_b
+
+    @classmethod
+    def from_blocks(cls, block_a, block_b):
+        fused = cls(block_a.conv1.in_channels, block_a.conv5.out_channels, gc=block_a.conv1.out_channels,
+                    bias=block_a.conv1.bias is not None)
+        fused.load_state_dict(cls.merge_state(block_a.state_dict(), block_b.state_dict()))
+        # grouped convs only take the fast (oneDNN) path in channels_last on CPU
+        return fused.to(block_a.conv1.weight.device, memory_format=torch.channels_last)
+
+    def forward(self, x) -> Tuple[torch.Tensor, torch.Tensor]:
+        if torch.is_grad_enabled() and not torch.jit.is_scripting():
+            return self.forward_cat(x)
+        return self.forward_buffer(x)
+
+    @torch.jit.unused
+    def forward_cat(self, x) -> Tuple[torch.Tensor, torch.Tensor]:
+        gc = self.gc
+        x1 = self.lrelu(self.conv1(x))
+        a, b = [x, x1[:, :gc]], [x, x1[:, gc:]]
+        for conv in (self.conv2, self.conv3, self.conv4):
+            xk = self.lrelu(conv(torch.cat(a[::-1] + b, 1)))
+            a.append(xk[:, :gc])
+            b.append(xk[:, gc:])
+        x5 = self.conv5(torch.cat(a[::-1] + b, 1))
+
+        return x5[:, :self.channel_out], x5[:, self.channel_out:]
+
+    def forward_buffer(self, x) -> Tuple[torch.Tensor, torch.Tensor]:
+        # inference only: each layer writes into its slots of one preallocated buffer, no cat
+        gc, mid = self.gc, self.channel_in + 4 * self.gc
+        n, c, h, w = x.shape[0], x.shape[1], x.shape[2], x.shape[3]
+        buf = x.new_empty((n, 2 * mid, h, w)).contiguous(memory_format=torch.channels_last)
+        buf[:, mid - c:mid + c] = x.repeat(1, 2, 1, 1)
+        lo, hi = mid - c, mid + c
+
+        # unrolled, TorchScript cannot loop over differently shaped convs
+        xk = self.lrelu(self.conv1(x))
+        lo, hi = self._put(buf, xk, lo, hi)
+        xk = self.lrelu(self.conv2(buf[:, lo:hi]))
+        lo, hi = self._put(buf, xk, lo, hi)
+        xk = self.lrelu(self.conv3(buf[:, lo:hi]))
+        lo, hi = self._put(buf, xk, lo, hi)
+        xk = self.lrelu(self.conv4(buf[:, lo:hi]))
+        self._put(buf, xk, lo, hi)
+        x5 = self.conv5(buf)
+
+        return x5[:, :self.channel_out], x5[:, self.channel_out:]
+
+    def _put(self, buf, xk, lo: int, hi: int) -> Tuple[int, int]:
+        # the two groups' new features go to either side of the filled slice [lo, hi)
+        gc = self.gc
+        buf[:, lo - gc:lo] = xk[:, :gc]
+        buf[:, hi:hi + gc] = xk[:, gc:]
+        return lo - gc, hi + gc
+
+def subnet(net_structure, init='xavier', memory_efficient=False):
     def constructor(channel_in, channel_out):
         if net_structure == 'DBNet':
             if init == 'xavier':
-                return DenseBlock(channel_in, channel_out, init)
+                return DenseBlock(channel_in, channel_out, init, memory_efficient=memory_efficient)
             else:
-                return DenseBlock(channel_in, channel_out)
+                return DenseBlock(channel_in, channel_out, memory_efficient=memory_efficient)
             # return UNetBlock(channel_in, channel_out)
         else:
             return None
@@ -89,6 +245,13 @@ def subnet(net_structure, init='xavier'):
     return constructor
 
 
+def variable_augment(x, channel_num=3):
+    # [N,1,H,W] slice -> [N,channel_num,H,W] copies, expanded on the device the model runs on
+    if x.size(1) == channel_num:
+        return x
+    return x.expand(-1, channel_num, -1, -1)
+
+
 class InvBlock(nn.Module):
     def __init__(self, subnet_constructor, channel_num, channel_split_num, clamp=0.8):
         super(InvBlock, self).__init__()
@@ -106,38 +269,100 @@ class InvBlock(nn.Module):
 
         in_channels = 3  ##修改进网络的通道数        
         self.invconv = InvertibleConv1x1(in_channels, LU_decomposed=True)
-        self.flow_permutation = lambda z, logdet, rev: self.invconv(z, logdet, rev)  
+        self.GH = None
+        # bf16 autocast for the F/G/H subnets only; coupling and 1x1 flow conv stay float32
+        self.bf16 = False
+
+    def fuse_gh(self):
+        """
+        Replace G/H by one FusedDenseBlock. state_dict() still reads and writes
+        the G.*/H.* keys, so checkpoints stay interchangeable with the unfused net.
+        """
+        self.GH = FusedDenseBlock.from_blocks(self.G, self.H)
+        del self.G
+        del self.H
+        self._register_state_dict_hook(InvBlock._split_gh_state)
+        self._register_load_state_dict_pre_hook(InvBlock._merge_gh_state)
+
+    @staticmethod
+    def _split_gh_state(module, state_dict, prefix, local_metadata):
+        fused = {k[len(prefix + 'GH.'):]: state_dict.pop(k) for k in list(state_dict) if k.startswith(prefix + 'GH.')}
+        state_g, state_h = FusedDenseBlock.split_state(fused)
+        for k in fused:
+            state_dict[prefix + 'G.' + k] = state_g[k]
+            state_dict[prefix + 'H.' + k] = state_h[k]
+        return state_dict
+
+    @staticmethod
+    def _merge_gh_state(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        state_g = {k[len(prefix + 'G.'):]: k for k in state_dict if k.startswith(prefix + 'G.')}
+        state_h = {k[len(prefix + 'H.'):]: k for k in state_dict if k.startswith(prefix + 'H.')}
+        if not state_g or set(state_g) != set(state_h):
+            return
+        fused = FusedDenseBlock.merge_state({k: state_dict.pop(v) for k, v in state_g.items()},
+                                            {k: state_dict.pop(v) for k, v in state_h.items()})
+        for k, v in fused.items():
+            state_dict[prefix + 'GH.' + k] = v
+
+    def gh(self, x) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.bf16 and not torch.jit.is_scripting():
+            with torch.autocast(x.device.type, dtype=torch.bfloat16):
+                g, h = self.gh_float(x)
+            return g.float(), h.float()
+        return self.gh_float(x)
+
+    def gh_float(self, x) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.GH is not None:
+            return self.GH(x)
+        else:
+            return self.G(x), self.H(x)
+
+    def f(self, x):
+        if self.bf16 and not torch.jit.is_scripting():
+            with torch.autocast(x.device.type, dtype=torch.bfloat16):
+                return self.F(x).float()
+        return self.F(x)
+
+    def flow_permutation(self, z, rev: bool):
+        out, _ = self.invconv(z, None, rev)
+        return out
         
-    def forward(self, x, rev=False):
+    def forward(self, x, rev: bool = False):
         if not rev:            
             # invert1x1conv 
-            x, logdet = self.flow_permutation(x, logdet=0, rev=False) 
+            x = self.flow_permutation(x, rev=False) 
             
             # split to 1 channel and 2 channel. 
             x1, x2 = (x.narrow(1, 0, self.split_len1), x.narrow(1, self.split_len1, self.split_len2)) 
 
-            y1 = x1 + self.F(x2) # 1 channel 
-            s = self.clamp * (torch.sigmoid(self.H(y1)) * 2 - 1)
-            y2 = x2 * torch.exp(s) + self.G(y1) # 2 channel 
+            y1 = x1 + self.f(x2) # 1 channel 
+            g, h = self.gh(y1)
+            s = self.clamp * (torch.sigmoid(h) * 2 - 1)
+            y2 = x2 * torch.exp(s) + g # 2 channel 
             out = torch.cat((y1, y2), 1)
         else:
             # split. 
             x1, x2 = (x.narrow(1, 0, self.split_len1), x.narrow(1, self.split_len1, self.split_len2)) 
-            s = self.clamp * (torch.sigmoid(self.H(x1)) * 2 - 1)
-            y2 = (x2 - self.G(x1)) / torch.exp(s)
-            y1 = x1 - self.F(y2) 
+            g, h = self.gh(x1)
+            s = self.clamp * (torch.sigmoid(h) * 2 - 1)
+            y2 = (x2 - g) / torch.exp(s)
+            y1 = x1 - self.f(y2) 
 
             x = torch.cat((y1, y2), 1)            
 
             # inv permutation 
-            out, logdet = self.flow_permutation(x, logdet=0, rev=True)
+            out = self.flow_permutation(x, rev=True)
 
         return out
 
 class InvISPNet(nn.Module):
-    def __init__(self, channel_in=3, channel_out=3, subnet_constructor=subnet('DBNet'), block_num=8):   ##channel_in=4, channel_out=4修改进网络的通道数
+    def __init__(self, channel_in=3, channel_out=3, subnet_constructor=subnet('DBNet'), block_num=8, invertible_backprop=False, checkpoint=0, fuse_gh=False, bf16=False):   ##channel_in=4, channel_out=4修改进网络的通道数
         super(InvISPNet, self).__init__()
         operations = []
+        # rebuild block inputs from outputs in backward instead of storing activations
+        self.invertible_backprop = invertible_backprop
+        # gradient checkpointing policy: 0 = none, k = recompute every k blocks (1 = every block)
+        self.checkpoint = checkpoint
         
 
         current_channel = channel_in
@@ -152,6 +377,17 @@ class InvISPNet(nn.Module):
 
         self.initialize()
 
+        if fuse_gh:
+            for op in self.operations:
+                op.fuse_gh()
+        self.set_bf16(bf16)
+
+    def set_bf16(self, enabled=True):
+        # DenseBlock convs under bf16 autocast, see InvBlock.gh / InvBlock.f
+        for op in self.operations:
+            op.bf16 = enabled
+        return self
+
     def initialize(self):
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
@@ -168,7 +404,11 @@ class InvISPNet(nn.Module):
                 init.constant_(m.weight, 1)
                 init.constant_(m.bias.data, 0.0)
     
-    def forward(self, x, rev=False):
+    def forward(self, x, rev: bool = False):
+        if not torch.jit.is_scripting():
+            if torch.is_grad_enabled() and (self.invertible_backprop or self.checkpoint > 0):
+                return self.forward_memory(x, rev)
+
         out = x.clone() # x: [N,3,H,W] 
         #assert 0
         
@@ -176,8 +416,43 @@ class InvISPNet(nn.Module):
             for op in self.operations:
                 out = op.forward(out, rev)
         else:
-            for op in reversed(self.operations):
+            for op in self.operations[::-1]:
                 out = op.forward(out, rev)
         
         return out
 
+    @torch.jit.unused
+    def forward_memory(self, x, rev: bool = False):
+        # training-only memory policies, not part of scripted / exported graphs
+        ops = list(self.operations) if not rev else list(reversed(self.operations))
+        if self.invertible_backprop:
+            params = [p for p in self.parameters() if p.requires_grad]
+            return InvertibleBackprop.apply(x, ops, rev, *params)
+
+        out = x.clone()
+        for i in range(0, len(ops), self.checkpoint):
+            out = checkpoint_fn(self.run_segment, ops[i:i + self.checkpoint], out, rev, use_reentrant=False)
+        return out
+
+    def subnets_channels_last(self):
+        # NHWC weights for the DenseBlock convs (oneDNN fast path on CPU); the 1x1 flow convs stay as they are
+        for m in self.modules():
+            if isinstance(m, (DenseBlock, FusedDenseBlock)):
+                m.to(memory_format=torch.channels_last)
+        return self
+
+    @staticmethod
+    def run_segment(ops, x, rev):
+        for op in ops:
+            x = op.forward(x, rev)
+        return x
+
+
+class InvISPReverse(nn.Module):
+    """The reverse mapping as a module of its own, so it can be scripted / exported as a separate graph."""
+    def __init__(self, net):
+        super(InvISPReverse, self).__init__()
+        self.net = net
+
+    def forward(self, x):
+        return self.net(x, rev=True)
@@ -1,4 +1,6 @@
 import math
+from typing import Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -311,15 +313,17 @@ class SqueezeLayer(nn.Module):
 
 
 class InvertibleConv1x1(nn.Module):
+    __constants__ = ['LU_decomposed']
+
     def __init__(self, num_channels, LU_decomposed):
         super().__init__()
         w_shape = [num_channels, num_channels]
-        w_init = torch.qr(torch.randn(*w_shape))[0]
+        w_init = torch.linalg.qr(torch.randn(*w_shape))[0]
 
         if not LU_decomposed:
             self.weight = nn.Parameter(torch.Tensor(w_init))
         else:
-            p, lower, upper = torch.lu_unpack(*torch.lu(w_init))
+            p, lower, upper = torch.linalg.lu(w_init)
             s = torch.diag(upper)
             sign_s = torch.sign(s)
             log_s = torch.log(torch.abs(s))
@@ -332,15 +336,53 @@ class InvertibleConv1x1(nn.Module):
             self.lower = nn.Parameter(lower)
             self.log_s = nn.Parameter(log_s)
             self.upper = nn.Parameter(upper)
-            self.l_mask = l_mask
-            self.eye = eye
+            # constants, follow the module across .to() but stay out of the state dict
+            self.register_buffer("l_mask", l_mask, persistent=False)
+            self.register_buffer("eye", eye, persistent=False)
 
         self.w_shape = w_shape
         self.LU_decomposed = LU_decomposed
+        self._cache_key = None
+        self._cache = None
+
+    def train(self, mode=True):
+        # drop the cached weights on mode switches, eval() recomposes once from the current parameters
+        self._cache_key = None
+        self._cache = None
+        return super().train(mode)
+
+    def compose(self, forward: bool = True, reverse: bool = True):
+        """
+        W = P L U and W^-1 = U^-1 L^-1 P^T, the inverse from two triangular solves.
+        """
+        lower = self.lower * self.l_mask + self.eye
+
+        u = self.upper * self.l_mask.transpose(0, 1).contiguous()
+        u = u + torch.diag(self.sign_s * torch.exp(self.log_s))
+
+        weight: Optional[torch.Tensor] = None
+        weight_inv: Optional[torch.Tensor] = None
+        if forward:
+            weight = torch.matmul(self.p, torch.matmul(lower, u))
+        if reverse:
+            l_inv_p = torch.linalg.solve_triangular(lower, self.p.transpose(0, 1), upper=False, unitriangular=True)
+            weight_inv = torch.linalg.solve_triangular(u, l_inv_p, upper=True)
 
-    def get_weight(self, input, reverse):  
-        b, c, h, w = input.shape
- 
+        return weight, weight_inv
+
+    @torch.jit.unused
+    def cached_weight(self):
+        # only used when no grad is needed; the key changes whenever a parameter is updated in place or moved
+        key = tuple((t._version, t.data_ptr(), t.device, t.dtype) for t in (self.lower, self.upper, self.log_s, self.p, self.sign_s))
+        if key != self._cache_key:
+            with torch.no_grad():
+                weight, weight_inv = self.compose()
+                self._cache = (weight, weight_inv, torch.sum(self.log_s))
+            self._cache_key = key
+        return self._cache
+
+    def get_weight(self, input, reverse: bool):
+        h, w = input.shape[2], input.shape[3]
 
         if not self.LU_decomposed:
             dlogdet = torch.slogdet(self.weight)[1] * h * w
@@ -349,30 +391,23 @@ class InvertibleConv1x1(nn.Module):
             else:
                 weight = self.weight
         else:
-            self.l_mask = self.l_mask.to(input.device)
-            self.eye = self.eye.to(input.device)
-
-            lower = self.lower * self.l_mask + self.eye
-
-            u = self.upper * self.l_mask.transpose(0, 1).contiguous()
-            u += torch.diag(self.sign_s.clone() * torch.exp(self.log_s))
+            # scripted / compiled graphs compose the weights in the graph (folded when frozen), eager
+            # inference reuses the cache
+            if torch.jit.is_scripting() or torch.compiler.is_compiling() or (torch.is_grad_enabled() and self.lower.requires_grad):
+                weight, weight_inv = self.compose(forward=not reverse, reverse=reverse)
+                log_s_sum = torch.sum(self.log_s)
+            else:
+                weight, weight_inv, log_s_sum = self.cached_weight()
 
-            dlogdet = torch.sum(self.log_s) * h * w
-            
-            #assert 0
+            dlogdet = log_s_sum * h * w
 
             if reverse:
-                u_inv = torch.inverse(u)
-                l_inv = torch.inverse(lower)
-                p_inv = torch.inverse(self.p)
-
-                weight = torch.matmul(u_inv, torch.matmul(l_inv, p_inv))
-            else:
-                weight = torch.matmul(self.p.clone(), torch.matmul(lower, u))
+                weight = weight_inv
 
+        assert weight is not None
         return weight.view(self.w_shape[0], self.w_shape[1], 1, 1), dlogdet
 
-    def forward(self, input, logdet=None, reverse=False):
+    def forward(self, input, logdet: Optional[torch.Tensor] = None, reverse: bool = False):
         """
         log-det = log|abs(|W|)| * pixels
         """
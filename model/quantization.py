@@ -0,0 +1,78 @@
+import copy
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert
+from torch.ao.nn.quantized import FloatFunctional
+
+from .model import DenseBlock
+
+
+class QuantDenseBlock(nn.Module):
+    """
+    DenseBlock for eager-mode post-training static quantization: the input is
+    quantized on entry and dequantized on exit, so the coupling arithmetic of
+    InvBlock and the 1x1 flow convs stay in float. Every cat and activation has
+    its own observer.
+    """
+    def __init__(self, channel_in, channel_out, gc=32, bias=True):
+        super(QuantDenseBlock, self).__init__()
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
+        self.conv1 = nn.Conv2d(channel_in, gc, 3, 1, 1, bias=bias)
+        self.conv2 = nn.Conv2d(channel_in + gc, gc, 3, 1, 1, bias=bias)
+        self.conv3 = nn.Conv2d(channel_in + 2 * gc, gc, 3, 1, 1, bias=bias)
+        self.conv4 = nn.Conv2d(channel_in + 3 * gc, gc, 3, 1, 1, bias=bias)
+        self.conv5 = nn.Conv2d(channel_in + 4 * gc, channel_out, 3, 1, 1, bias=bias)
+        self.lrelu1 = nn.LeakyReLU(negative_slope=0.2)
+        self.lrelu2 = nn.LeakyReLU(negative_slope=0.2)
+        self.lrelu3 = nn.LeakyReLU(negative_slope=0.2)
+        self.lrelu4 = nn.LeakyReLU(negative_slope=0.2)
+        self.cat2 = FloatFunctional()
+        self.cat3 = FloatFunctional()
+        self.cat4 = FloatFunctional()
+        self.cat5 = FloatFunctional()
+
+    @classmethod
+    def from_block(cls, block):
+        q = cls(block.conv1.in_channels, block.conv5.out_channels, gc=block.conv1.out_channels,
+                bias=block.conv1.bias is not None)
+        q.load_state_dict(block.state_dict())
+        return q.to(block.conv1.weight.device)
+
+    def forward(self, x):
+        x = self.quant(x)
+        x1 = self.lrelu1(self.conv1(x))
+        x2 = self.lrelu2(self.conv2(self.cat2.cat([x, x1], 1)))
+        x3 = self.lrelu3(self.conv3(self.cat3.cat([x, x1, x2], 1)))
+        x4 = self.lrelu4(self.conv4(self.cat4.cat([x, x1, x2, x3], 1)))
+        x5 = self.conv5(self.cat5.cat([x, x1, x2, x3, x4], 1))
+
+        return self.dequant(x5)
+
+
+def quantize_subnets(net, calibrate, backend='x86'):
+    """
+    int8 copy of an InvISPNet: the F/G/H DenseBlocks of every InvBlock are replaced by
+    QuantDenseBlocks, observed while calibrate(net) runs, then converted. Everything
+    else (coupling, InvertibleConv1x1) is left in float.
+    """
+    torch.backends.quantized.engine = backend
+    qnet = copy.deepcopy(net).cpu().eval()
+    qconfig = get_default_qconfig(backend)
+    for op in qnet.operations:
+        if op.GH is not None:
+            raise ValueError("quantize the unfused net (fuse_gh=False)")
+        for name in ('F', 'G', 'H'):
+            block = getattr(op, name)
+            if not isinstance(block, DenseBlock):
+                raise TypeError("only DenseBlock subnets can be quantized, got {}".format(type(block).__name__))
+            block = QuantDenseBlock.from_block(block)
+            block.qconfig = qconfig
+            setattr(op, name, block)
+
+    prepare(qnet, inplace=True)
+    with torch.no_grad():
+        calibrate(qnet)
+    convert(qnet, inplace=True)
+    return qnet
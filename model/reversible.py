@@ -0,0 +1,55 @@
+import torch
+
+
+class InvertibleBackprop(torch.autograd.Function):
+    """
+    Memory-free backprop through a chain of InvBlocks (RevNet / i-RevNet style).
+
+    The forward pass keeps no activations but the chain output. During backward
+    each block's input is rebuilt from its output with the opposite direction of
+    InvBlock.forward, the block is re-run with grad enabled and its local
+    gradients are taken, so activation memory does not grow with block_num.
+
+    The parameters are passed as inputs so their grads flow through autograd
+    (and the DDP reduction hooks).
+    """
+
+    @staticmethod
+    def forward(ctx, x, blocks, rev, *params):
+        ctx.blocks = blocks
+        ctx.rev = rev
+        ctx.params = params
+
+        with torch.no_grad():
+            out = x
+            for op in blocks:
+                out = op.forward(out, rev)
+
+        ctx.save_for_backward(out)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        out, = ctx.saved_tensors
+        y = out.detach()
+        grads = {}
+
+        for op in reversed(ctx.blocks):
+            with torch.no_grad():
+                x = op.forward(y, not ctx.rev)
+
+            with torch.enable_grad():
+                x = x.detach().requires_grad_(True)
+                y_rebuilt = op.forward(x, ctx.rev)
+                params = [p for p in op.parameters() if p.requires_grad]
+                local_grads = torch.autograd.grad(y_rebuilt, [x] + params, grad_out, allow_unused=True)
+
+            grad_out = local_grads[0]
+            for p, g in zip(params, local_grads[1:]):
+                if g is not None:
+                    grads[p] = grads[p] + g if p in grads else g
+            y = x.detach()
+
+        param_grads = tuple(grads.get(p) for p in ctx.params)
+        ctx.blocks = ctx.params = None
+        return (grad_out, None, None) + param_grads
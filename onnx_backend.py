@@ -0,0 +1,35 @@
+import os
+import sys
+
+import numpy as np
+
+
+# ONNX Runtime runner for the graphs written by `export.py --format onnx`.
+# Needs only numpy and onnxruntime, torch is not imported here.
+
+class OnnxNet(object):
+    """
+    forward.onnx / reverse.onnx on the CPU execution provider, called like InvISPNet:
+    net(x) and net(x, rev=True). Takes and returns numpy arrays, or torch tensors if given
+    torch tensors.
+    """
+    def __init__(self, path, num_threads=0, providers=('CPUExecutionProvider',)):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("the onnx backend needs onnxruntime: pip install onnxruntime")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.forward_graph = ort.InferenceSession(os.path.join(path, 'forward.onnx'), options, providers=list(providers))
+        self.reverse_graph = ort.InferenceSession(os.path.join(path, 'reverse.onnx'), options, providers=list(providers))
+
+    def __call__(self, x, rev=False):
+        session = self.reverse_graph if rev else self.forward_graph
+        torch = sys.modules.get('torch')
+        if torch is not None and isinstance(x, torch.Tensor):
+            out = session.run(None, {'input': np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)})[0]
+            return torch.from_numpy(out).to(x.device)
+        return session.run(None, {'input': np.ascontiguousarray(x, dtype=np.float32)})[0]
@@ -0,0 +1,99 @@
+import time
+import argparse
+import warnings
+
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from model.model import variable_augment
+from model.quantization import quantize_subnets
+from dataset.mri_dataset import mriDataset
+from config.config import get_arguments
+from metrics import evaluate, RunningStats
+from export import build, export_torchscript
+
+
+# int8 post-training static quantization of the DenseBlock subnets, calibrated on
+# data_for_training, with the PSNR/SSIM delta against the float model on data_for_test.
+
+def loader(args, root1, root2, root3, num=0):
+    dataset = mriDataset(opt=argparse.Namespace(task=args.task, store=None), root1=root1, root2=root2, root3=root3)
+    if num > 0:
+        # evenly spread over the set rather than the first slices of one volume
+        step = max(len(dataset) // num, 1)
+        dataset = Subset(dataset, list(range(0, len(dataset), step))[:num])
+    return DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=0, drop_last=False)
+
+
+def run(net, input):
+    # test.py's forward + reverse pass
+    reconstruct_for = torch.clamp(net(variable_augment(input)), 0, 1)
+    reconstruct_rev = torch.clamp(net(reconstruct_for, rev=True), 0, 1)
+    pred_for = reconstruct_for.mean(1)
+    pred_rev = (reconstruct_rev[:, 0] + reconstruct_rev[:, 1]) / 2
+    return pred_for, pred_rev
+
+
+def compare(net, qnet, dataloader):
+    stats = {k: RunningStats() for k in ('psnr', 'ssim', 'psnr_rev', 'ssim_rev')}
+    stats_int8 = {k: RunningStats() for k in stats}
+    delta = {k: RunningStats() for k in stats}
+    times = {'float': 0., 'int8': 0.}
+    for sample_batched in dataloader:
+        input, target = sample_batched['input_img'], sample_batched['target_forward_img'][:, 0]
+        results = {}
+        for name, model in (('float', net), ('int8', qnet)):
+            t = time.time()
+            with torch.inference_mode():
+                pred_for, pred_rev = run(model, input)
+            times[name] += time.time() - t
+            results[name] = evaluate(pred_for, target, pred_rev, input[:, 0])
+        for k in stats:
+            for a, b in zip(results['float'][k].tolist(), results['int8'][k].tolist()):
+                stats[k].add(a)
+                stats_int8[k].add(b)
+                delta[k].add(b - a)
+    return stats, stats_int8, delta, times
+
+
+def main(args):
+    net = build(args.ckpt)
+    print("[INFO] Loaded checkpoint: {}".format(args.ckpt))
+
+    calib = loader(args, args.calib_root1, args.calib_root2, args.calib_root3, args.calib_num)
+    def calibrate(qnet):
+        for sample_batched in calib:
+            run(qnet, sample_batched['input_img'])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        qnet = quantize_subnets(net, calibrate, args.engine)
+    print("[INFO] Calibrated on {} slices of {}".format(len(calib.dataset), args.calib_root2))
+
+    stats, stats_int8, delta, times = compare(net, qnet, loader(args, args.root1, args.root2, args.root3))
+    print("%-10s %12s %12s %12s %10s" % ("metric", "float", "int8", "delta", "max |d|"))
+    for k in stats:
+        print("%-10s %12.4f %12.4f %12.4f %10.4f" % (k, stats[k].mean, stats_int8[k].mean, delta[k].mean,
+                                                    max(abs(delta[k].min), abs(delta[k].max))))
+    print("[INFO] forward + reverse: float {:.3f}s  int8 {:.3f}s  speedup {:.2f}x".format(
+        times['float'], times['int8'], times['float'] / times['int8']))
+
+    if args.out_path:
+        paths = export_torchscript(qnet, args.out_path)
+        print("[INFO] Exported {}".format(", ".join(paths.values())))
+
+
+if __name__ == '__main__':
+    parser = get_arguments()
+    parser.add_argument("--ckpt", type=str, required=True, help="Float checkpoint path. ")
+    parser.add_argument("--calib_root1", type=str, default="./data_for_training/ct_mat")
+    parser.add_argument("--calib_root2", type=str, default="./data_for_training/pet_mat")
+    parser.add_argument("--calib_root3", type=str, default="./data_for_training/pet_mat")
+    parser.add_argument("--calib_num", type=int, default=64, help="Calibration slices, 0 = all. ")
+    parser.add_argument("--root1", type=str, default="./data_for_test/ct_mat")
+    parser.add_argument("--root2", type=str, default="./data_for_test/pet_mat")
+    parser.add_argument("--root3", type=str, default="./data_for_test/pet_mat")
+    parser.add_argument("--engine", type=str, default="x86", help="Quantized engine: x86, fbgemm, onednn, qnnpack. ")
+    parser.add_argument("--out_path", type=str, default="", help="Also write the int8 forward.pt / reverse.pt here (test.py --backend torchscript). ")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,111 @@
+import os, sys, time
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from model.model import InvISPNet, subnet
+
+
+# 显存/时间对比：不同的 checkpoint 策略与 batch size
+POLICIES = {
+    'none': dict(),
+    'invertible': dict(invertible_backprop=True),
+    'shared-concat': dict(subnet_constructor=subnet('DBNet', memory_efficient=True)),
+}
+
+
+def recompute_blocks(kw, block_num):
+    # blocks whose activations are alive at once while backward recomputes a segment
+    if kw.get('invertible_backprop'):
+        return 1
+    if kw.get('checkpoint', 0) > 0:
+        return min(kw['checkpoint'], block_num)
+    return 0
+
+
+def saved_bytes(net, x):
+    """Bytes autograd keeps for backward (weights excluded) for one forward + reverse pass."""
+    seen = {}
+
+    def pack(t):
+        if not isinstance(t, nn.Parameter):
+            seen[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        f = torch.clamp(net(x), 0, 1)
+        r = torch.clamp(net(f, rev=True), 0, 1)
+    del f, r
+    return sum(seen.values())
+
+
+def step_time(net, x, iters):
+    optimizer = torch.optim.Adam(net.parameters(), lr=1e-4)
+    times = []
+    for i in range(iters + 1):
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        t = time.time()
+        f = torch.clamp(net(x), 0, 1)
+        r = torch.clamp(net(f, rev=True), 0, 1)
+        loss = F.l1_loss(f, x) + F.l1_loss(r, x)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        if i > 0:  # first iteration is warm-up
+            times.append(time.time() - t)
+    return sum(times) / len(times)
+
+
+def main(args):
+    device = torch.device(args.device)
+    policies = dict(POLICIES)
+    for k in args.checkpoint:
+        policies['checkpoint=%d' % k] = dict(checkpoint=k)
+
+    print("%-14s %6s %12s %12s %12s %10s" % ("policy", "batch", "saved MB", "est. MB", "peak MB", "step s"))
+    best = {}
+    per_block = {}
+    for name, kw in policies.items():
+        for batch_size in args.batch_sizes:
+            net = InvISPNet(channel_in=3, channel_out=3, block_num=args.block_num, **kw).to(device)
+            x = torch.rand(batch_size, 3, args.size, args.size, device=device)
+
+            saved = saved_bytes(net, x) / 2 ** 20
+            if name == 'none':
+                # one block, one direction
+                per_block[batch_size] = saved / (2 * args.block_num)
+            estimate = saved + recompute_blocks(kw, args.block_num) * per_block[batch_size]
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+            t = step_time(net, x, args.iters)
+            peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else float('nan')
+
+            print("%-14s %6d %12.1f %12.1f %12.1f %10.3f" % (name, batch_size, saved, estimate, peak, t))
+            used = peak if device.type == 'cuda' else estimate
+            if args.budget_mb and used <= args.budget_mb:
+                best[name] = (batch_size, batch_size / t)
+            del net, x
+
+    if args.budget_mb:
+        print("[INFO] largest batch within %d MB:" % args.budget_mb)
+        for name, (batch_size, throughput) in best.items():
+            print("  %-14s batch %d  %.2f slices/s" % (name, batch_size, throughput))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="activation memory / step time of the checkpointing policies")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--size", type=int, default=256, help="Slice size. ")
+    parser.add_argument("--block_num", type=int, default=8)
+    parser.add_argument("--batch_sizes", type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument("--checkpoint", type=int, nargs='+', default=[1, 2, 4], help="Checkpoint every k blocks. ")
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--budget_mb", type=int, default=0, help="Memory budget used to pick the largest batch size. ")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,60 @@
+import os, sys
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from model.model import InvISPNet, subnet, variable_augment
+from dataset.mri_dataset import mriDataset
+from metrics import psnr
+from checkpointing import load_checkpoint
+
+
+# bf16 subnets must not degrade the cycle: PET -> sCT -> PET error of the bf16 net vs the float32 net
+
+def cycle(net, x):
+    with torch.inference_mode():
+        f = torch.clamp(net(x), 0, 1)
+        r = net(f, rev=True)
+    return f, r
+
+
+def main(args):
+    device = torch.device(args.device)
+    net = InvISPNet(channel_in=3, channel_out=3, subnet_constructor=subnet('DBNet'), block_num=8).to(device).eval()
+    if args.ckpt:
+        load_checkpoint(net, args.ckpt, block_num=8)
+        print("[INFO] Loaded checkpoint: {}".format(args.ckpt))
+
+    if args.root2:
+        dataset = mriDataset(opt=argparse.Namespace(task='1to1', store=None), root1=args.root2, root2=args.root2, root3=args.root2)
+        x = torch.stack([dataset[i]['input_img'] for i in range(min(args.num, len(dataset)))])
+    else:
+        x = torch.rand(args.num, 1, args.size, args.size, generator=torch.Generator().manual_seed(0))
+    x = variable_augment(x.to(device))
+
+    f32, r32 = cycle(net.set_bf16(False), x)
+    f16, r16 = cycle(net.set_bf16(True), x)
+
+    err32 = (r32 - x).abs().max().item()
+    err16 = (r16 - x).abs().max().item()
+    psnr32 = psnr(x[:, 0], r32.clamp(0, 1)[:, 0]).mean().item()
+    psnr16 = psnr(x[:, 0], r16.clamp(0, 1)[:, 0]).mean().item()
+    print("[INFO] forward max |bf16 - fp32|: {:.3g}".format((f16 - f32).abs().max().item()))
+    print("[INFO] cycle max |x - rev(for(x))|: fp32 {:.3g}  bf16 {:.3g}".format(err32, err16))
+    print("[INFO] cycle PSNR: fp32 {:.3f} dB  bf16 {:.3f} dB".format(psnr32, psnr16))
+    if psnr16 < psnr32 - args.tol_db:
+        raise SystemExit("[ERROR] bf16 cycle PSNR is {:.3f} dB below fp32 (tolerance {} dB)".format(psnr32 - psnr16, args.tol_db))
+    print("[INFO] bf16 reverse reconstruction within {} dB of fp32".format(args.tol_db))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="check the bf16 subnets against float32 on the PET -> sCT -> PET cycle")
+    parser.add_argument("--ckpt", type=str, default="", help="Checkpoint, default: random init. ")
+    parser.add_argument("--root2", type=str, default="", help="PET .mat slices, default: random slices. ")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num", type=int, default=4)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--tol_db", type=float, default=0.5, help="Allowed cycle PSNR drop of bf16. ")
+    args = parser.parse_args()
+    main(args)
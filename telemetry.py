@@ -0,0 +1,86 @@
+import time
+from contextlib import contextmanager
+
+import torch
+
+from utils import synchronize
+
+
+class Telemetry(object):
+    """
+    Training scalars kept as detached tensors on the training device and summed there;
+    flush() moves all of them to the host in one transfer (one sync) every `interval`
+    steps and writes the means to TensorBoard. phase() adds up per-phase wall time.
+
+    With sync_timing the device is synchronized at every phase boundary, so GPU phases
+    are timed exactly (at the cost of the overlap); without it CUDA phases only measure
+    the launch time and the waiting shows up in whichever phase syncs next.
+    With writer=None (ranks other than 0) everything is a no-op.
+    """
+    PHASES = ('data', 'forward', 'reverse', 'backward', 'step')
+
+    def __init__(self, writer, interval=50, device=None, sync_timing=False):
+        self.writer = writer
+        self.enabled = writer is not None
+        self.interval = interval
+        self.device = device
+        self.sync_timing = sync_timing
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.times = dict.fromkeys(self.PHASES, 0.)
+        self.steps = 0
+        self.slices = 0
+        self.start = time.perf_counter()
+
+    def add(self, **scalars):
+        if not self.enabled:
+            return
+        for k, v in scalars.items():
+            v = v.detach()
+            self.sums[k] = self.sums[k] + v if k in self.sums else v.clone()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        if self.sync_timing:
+            synchronize(self.device)
+        t = time.perf_counter()
+        yield
+        if self.sync_timing:
+            synchronize(self.device)
+        self.times[name] = self.times.get(name, 0.) + time.perf_counter() - t
+
+    def step(self, global_step, slices=0):
+        """Call once per iteration; returns the flushed means every `interval` steps, else None."""
+        if not self.enabled:
+            return None
+        self.steps += 1
+        self.slices += slices
+        if self.steps >= self.interval:
+            return self.flush(global_step)
+        return None
+
+    def flush(self, global_step):
+        if not self.enabled or self.steps == 0:
+            return None
+        keys = list(self.sums)
+        values = torch.stack([self.sums[k].float() for k in keys]).tolist() if keys else []
+        means = {k: v / self.steps for k, v in zip(keys, values)}
+        elapsed = time.perf_counter() - self.start
+
+        for k, v in means.items():
+            self.writer.add_scalar(k, v, global_step=global_step)
+        for k, v in self.times.items():
+            # milliseconds per iteration
+            self.writer.add_scalar('time/' + k, 1000 * v / self.steps, global_step=global_step)
+        self.writer.add_scalar('time/iteration', 1000 * elapsed / self.steps, global_step=global_step)
+        if self.slices:
+            self.writer.add_scalar('slices_per_sec_rank0', self.slices / elapsed, global_step=global_step)
+
+        means['times'] = {k: v / self.steps for k, v in self.times.items()}
+        self.reset()
+        return means
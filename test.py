@@ -4,23 +4,26 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 import torch
+import torch.multiprocessing as mp
 import numpy as np
-import os, time, random
+import os, time, random, glob
 import argparse
+import csv, json
 from torch.utils.data import Dataset, DataLoader
 from PIL import Image as PILImage
 
-from model.model import InvISPNet
+from model.model import InvISPNet, subnet, variable_augment
 from dataset.mri_dataset import mriDataset
+from dataset.resident import decode_all
 from config.config import get_arguments
+from metrics import evaluate, psnr, ssim, MetricAggregator, RunningStats
+from export import ExportedNet
+from checkpointing import load_checkpoint
+from utils import select_device, configure_threads, synchronize, save_img, save_mat, AsyncWriter, OUTPUT_PROFILES
 
 from tqdm import tqdm
 import cv2
 import imageio
-from skimage.metrics import peak_signal_noise_ratio as compare_psnr
-from skimage.metrics import structural_similarity as compare_ssim
-from skimage.metrics import mean_squared_error as compare_mse
-from skimage.metrics import normalized_root_mse as compare_nrmse
 from matplotlib import pyplot as plt
 import math
 import scipy.io as io
@@ -33,192 +36,320 @@ import pydicom
 # os.system('rm tmp')
 
 parser = get_arguments()
-parser.add_argument("--ckpt", type=str, default="./results/data_all_norm_black/1to1/checkpoint/0028.pth", help="Checkpoint path.") 
+parser.add_argument("--ckpt", type=str, default="./results/data_all_norm_black/1to1/checkpoint/0028.pth", help="Checkpoint path, or a checkpoint directory / glob to sweep.") 
 parser.add_argument("--out_path", type=str, default="./results/data_all_norm_black/", help="Path to save results. ")
 parser.add_argument("--root1", type=str, default="./black/ct_mat", help="Output images. ")
 parser.add_argument("--root2", type=str, default="./black/pet_mat", help="Input images. ")
 parser.add_argument("--root3", type=str, default="./black/pet_mat", help="Another input images. ")
-args = parser.parse_args()
-print("Parsed arguments: {}".format(args))
+parser.add_argument("--memory_efficient", dest='memory_efficient', action='store_true', help="Grow DenseBlock features in one shared buffer instead of torch.cat. ")
+parser.add_argument("--fuse_gh", dest='fuse_gh', action='store_true', help="Evaluate G/H of each block as one fused grouped-conv subnet. ")
+parser.add_argument("--device", type=str, default="auto", help="auto (GPU if present, else CPU), cpu, cuda:0, ... ")
+parser.add_argument("--num_threads", type=int, default=0, help="Intra-op CPU threads, 0 = torch default. ")
+parser.add_argument("--num_interop_threads", type=int, default=0, help="Inter-op CPU threads, 0 = torch default. ")
+parser.add_argument("--bf16", dest='bf16', action='store_true', help="Run the DenseBlock convs under bf16 autocast (eager backend). ")
+parser.add_argument("--channels_last", dest='channels_last', action='store_true', help="channels_last memory format for the DenseBlock convs. ")
+parser.add_argument("--output_profile", type=str, default="full", choices=list(OUTPUT_PROFILES), help="Which result images / mats to write. ")
+parser.add_argument("--writers", type=int, default=4, help="Background writer workers. ")
+parser.add_argument("--write_queue", type=int, default=64, help="Max queued writes before inference waits for the disk. ")
+parser.add_argument("--writer_processes", dest='writer_processes', action='store_true', help="Use writer processes instead of threads. ")
+parser.add_argument("--quantiles", type=float, nargs='*', default=[0.05, 0.5, 0.95], help="Streaming quantiles reported in summary.json. ")
+parser.add_argument("--sweep_workers", type=int, default=0, help="Worker processes sharing the decoded test set in a sweep, 0 = evaluate in this process. ")
+parser.add_argument("--rev_fraction", type=float, default=1.0, help="Fraction of slices that also get the reverse (cycle-consistency) pass, 0 = forward only. ")
+parser.add_argument("--rev_on_anomaly", type=float, default=0., help="Also run the reverse pass when the forward output mean/std is more than this many std from the running average, 0 = off. ")
+parser.add_argument("--backend", type=str, default="eager", choices=['eager', 'torchscript', 'onnx'], help="eager model, or the graphs written by export.py (--ckpt is then the export directory); onnx runs on ONNX Runtime's CPU provider. ")
+parser.add_argument("--rank_by", type=str, default="psnr", help="Metric the sweep table is ranked by. ")
+METRIC_KEYS = ['psnr', 'psnr_rev2', 'psnr_rev3', 'ssim', 'ssim_rev2', 'ssim_rev3', 'mse', 'nmse', 'rmse']
 
-ckpt_allname = args.ckpt.split("/")[-1]
 
+# lower is better for these, higher for the rest
+LOWER_IS_BETTER = ('mse', 'nmse', 'rmse')
+REV_KEYS = ('psnr_rev2', 'psnr_rev3', 'ssim_rev2', 'ssim_rev3')
+# slices seen before the forward statistics are trusted for --rev_on_anomaly
+ANOMALY_WARMUP = 8
 
-def save_img(img, img_path):
-    img = np.clip(img*255,0,255)
-    cv2.imwrite(img_path, img)
 
-def main(args):
-    # ======================================define the model============================================
+def sampled(idx, fraction):
+    # evenly spaced and independent of the batch size: slice i is checked when floor((i+1)f) steps
+    return math.floor((idx + 1) * fraction) > math.floor(idx * fraction)
+
+
+def anomalous(values, forward_stats, threshold):
+    # z-score of each forward output statistic against the running average of the earlier slices
+    for k, v in values.items():
+        st = forward_stats[k]
+        if st.count >= ANOMALY_WARMUP and st.std > 0 and abs(v - st.mean) / st.std > threshold:
+            return True
+    return False
+
+
+def list_checkpoints(ckpt):
+    # a file, a directory of .pth / .safetensors files or a glob pattern
+    if os.path.isdir(ckpt):
+        return sorted(glob.glob(os.path.join(ckpt, '*.pth')) + glob.glob(os.path.join(ckpt, '*.safetensors')))
+    if glob.has_magic(ckpt):
+        return sorted(glob.glob(ckpt))
+    return [ckpt]
+
+
+def build_net(args, device):
     #net = InvISPNet(channel_in=3, channel_out=3, block_num=8)
     
-    net = InvISPNet(channel_in=3, channel_out=3, block_num=8)
-    
-    device = torch.device("cuda:0")
-    
+    net = InvISPNet(channel_in=3, channel_out=3, subnet_constructor=subnet('DBNet', memory_efficient=args.memory_efficient),
+                    block_num=8, fuse_gh=args.fuse_gh, bf16=args.bf16)
     net.to(device)
+    if args.channels_last:
+        net.subnets_channels_last()
     net.eval()
-    # load the pretrained weight if there exists one
-    if os.path.isfile(args.ckpt):
-        net.load_state_dict(torch.load(args.ckpt), strict=False)
-        print("[INFO] Loaded checkpoint: {}".format(args.ckpt))
-    
-    print("[INFO] Start data load and preprocessing") 
+    return net
 
-    Dataset = mriDataset(opt=args,root1=args.root1,root2=args.root2,root3=args.root3)
-    dataloader = DataLoader(Dataset, batch_size=args.batch_size, shuffle=False, num_workers=0, drop_last=True)
-
-    PSNR=[]
-    PSNR_REV2=[]
-    PSNR_REV3=[]
-    SSIM=[]
-    SSIM_REV2=[]
-    SSIM_REV3=[]
-    MSE=[]
-    NMSE=[]
-    RMSE=[]
-    NRMSE=[]
-    TIME=[]
-    
-    print("[INFO] Start test...")
+
+def load_ckpt(net, ckpt, task):
+    # strict: a missing file or any missing / unexpected key fails instead of testing random weights
+    load_checkpoint(net, ckpt, block_num=len(net.operations), task=task)
+    print("[INFO] Loaded checkpoint: {}".format(ckpt))
+    return net
+
+
+def load_test_set(args):
+    """Decode every test slice once: {'input', 'target'} [N,1,H,W] float32 tensors plus the name lists."""
+    data = decode_all(mriDataset(opt=args,root1=args.root1,root2=args.root2,root3=args.root3), batch_size=max(args.batch_size, 16))
+    data['input'] = data.pop('input_img')
+    data['target'] = data.pop('target_forward_img')
+    return data
+
+
+def evaluate_ckpt(net, ckpt, data, args, device):
+    ckpt_allname = ckpt.split("/")[-1]
+    all_time = 0.
+    model_time_sum = 0.
     
-    for i_batch, sample_batched in enumerate(tqdm(dataloader)):
+    save_path= args.out_path+'/test/{}'.format(ckpt_allname)
+    outputs = OUTPUT_PROFILES[args.output_profile]
+    os.makedirs(save_path, exist_ok=True)
+    for d in outputs:
+        os.makedirs(save_path+'/'+d, exist_ok=True)
+    # per-slice rows go to metrics.csv, only running statistics stay in memory
+    stats = MetricAggregator(METRIC_KEYS, csv_path=save_path+'/metrics.csv', quantiles=args.quantiles)
+    writer = AsyncWriter(args.writers, args.write_queue, processes=args.writer_processes)
+    # running mean/std of the forward outputs, the reference for --rev_on_anomaly
+    forward_stats = {'mean': RunningStats(), 'std': RunningStats()}
+    rev_checked = 0
+
+    num = data['input'].size(0)
+    for start in tqdm(range(0, num, args.batch_size), desc=ckpt_allname):
         step_time = time.time() 
+        end = start + args.batch_size
 
-        input, target_forward, input_target = sample_batched['input_img'].to(device), sample_batched['target_forward_img'].to(device), \
-                            sample_batched['input_target_img'].to(device)
+        input, target_forward = data['input'][start:end].to(device), data['target'][start:end].to(device)
 
-        input_file_name2 = sample_batched['input2_name'][0]
-        input_file_name3 = sample_batched['input3_name'][0]
-        target_file_name = sample_batched['target_forward_name'][0]
+        input_file_names2 = data['input2_name'][start:end]
+        input_file_names3 = data['input3_name'][start:end]
+        target_file_names = data['target_forward_name'][start:end]
 
-        with torch.no_grad():
-            reconstruct_for = net(input)
+        synchronize(device)
+        model_time = time.time()
+        with torch.inference_mode():
+            reconstruct_for = net(variable_augment(input))
             reconstruct_for = torch.clamp(reconstruct_for, 0, 1)
-            reconstruct_rev = net(reconstruct_for, rev=True)
+        synchronize(device)
+        model_time_sum += time.time() - model_time
 
-        pred_rev = reconstruct_rev.detach().permute(0,2,3,1).squeeze()  
-        pred_rev = torch.clamp(pred_rev, 0, 1).cpu().numpy() 
-        pred_for = reconstruct_for.detach().permute(0,2,3,1).squeeze().cpu().numpy()   
-        target_forward_patch = target_forward.permute(0,2,3,1).squeeze().cpu().numpy()   
-        target_rev_patch = input_target.permute(0,2,3,1).squeeze().cpu().numpy()  
-        
-        pred_for_mean = (pred_for[:,:,0]+pred_for[:,:,1] + pred_for[:,:,2]) / 3.
-        target_forward_patch = (target_forward_patch[:,:,0]+target_forward_patch[:,:,1] + target_forward_patch[:,:,2]) / 3.
-        
-        if args.task == '2to1':
-            target_rev_2 = target_rev_patch[:,:,0]
-            target_rev_3 = target_rev_patch[:,:,1]
-            pred_rev_2 = pred_rev[:,:,0]
-            pred_rev_3 = pred_rev[:,:,1]
-            
-        if args.task == '1to1':    
-            target_rev_2 = (target_rev_patch[:,:,0]+target_rev_patch[:,:,1])/2
-            target_rev_3 = (target_rev_patch[:,:,0]+target_rev_patch[:,:,1])/2
-            pred_rev_2 = (pred_rev[:,:,0] +pred_rev[:,:,1])/2
-            pred_rev_3 = (pred_rev[:,:,0] +pred_rev[:,:,1])/2
-        
-        psnr = compare_psnr( 255 * abs(target_forward_patch),255 * abs(pred_for_mean), data_range=255)
-        psnr_rev_2 = compare_psnr( 255 * abs(target_rev_2),255 * abs(pred_rev_2), data_range=255)
-        psnr_rev_3 = compare_psnr( 255 * abs(target_rev_3),255 * abs(pred_rev_3), data_range=255)
-        ssim = compare_ssim(abs(target_forward_patch), abs(pred_for_mean), data_range=1)
-        ssim_rev_2 = compare_ssim(abs(target_rev_2), abs(pred_rev_2), data_range=1)
-        ssim_rev_3 = compare_ssim(abs(target_rev_3), abs(pred_rev_3), data_range=1)
-        mse = compare_mse(target_forward_patch,pred_for_mean)
-        rmse = math.sqrt(mse)
-
-        nmse =  np.sum((pred_for_mean - target_forward_patch) ** 2.) / np.sum(target_forward_patch**2)
-
-        PSNR.append(psnr)
-        PSNR_REV2.append(psnr_rev_2)
-        PSNR_REV3.append(psnr_rev_3)
-        SSIM.append(ssim)
-        SSIM_REV2.append(ssim_rev_2)
-        SSIM_REV3.append(ssim_rev_3)
-        MSE.append(mse)
-        NMSE.append(nmse)
-        RMSE.append(rmse)
-        save_path= args.out_path+'/test/{}'.format(ckpt_allname)
-        
-        os.makedirs(save_path+'/pred', exist_ok=True)
-        os.makedirs(save_path+'/pred_mat', exist_ok=True)
-        os.makedirs(save_path+'/target', exist_ok=True)           
-        os.makedirs(save_path+'/pred_rev_2', exist_ok=True)    
-        os.makedirs(save_path+'/pred_rev_3', exist_ok=True)
-        os.makedirs(save_path+'/target_rev_2', exist_ok=True)
-        os.makedirs(save_path+'/target_rev_3', exist_ok=True)
-
-        save_img(pred_for_mean, save_path+'/pred'+'/pred_'+target_file_name+'.png')
-        io.savemat(save_path+'/pred_mat'+'/pred_'+target_file_name+'.mat',{'img':pred_for_mean})
-
-        save_img(target_forward_patch, save_path+'/target'+'/target_'+target_file_name+'.png')
-        save_img(pred_rev_2, save_path+'/pred_rev_2'+'/pred_rev_'+input_file_name2+'.png')  
-        save_img(pred_rev_3, save_path+'/pred_rev_3'+'/pred_rev_'+input_file_name3+'.png')
-        save_img(target_rev_2, save_path+'/target_rev_2'+'/target_rev_'+input_file_name2+'.png')  
-        save_img(target_rev_3, save_path+'/target_rev_3'+'/target_rev_'+input_file_name3+'.png')
-        
-        times =  time.time()-step_time
+        # [N,3,H,W] -> [N,H,W]: channel averaging for the whole batch at once
+        pred_for_mean = (reconstruct_for[:,0]+reconstruct_for[:,1]+reconstruct_for[:,2]) / 3.
+        # targets are single channel, no channel averaging needed
+        target_forward_patch = target_forward[:,0]
+        target_rev_patch = input[:,0]
+
+        # which slices pay for the reverse pass: a sampled fraction plus forward outputs that look off
+        out_mean = pred_for_mean.mean(dim=(-2, -1)).tolist()
+        out_std = pred_for_mean.std(dim=(-2, -1)).tolist()
+        check = []
+        for j in range(len(target_file_names)):
+            values = {'mean': out_mean[j], 'std': out_std[j]}
+            if sampled(start + j, args.rev_fraction) or (args.rev_on_anomaly > 0 and anomalous(values, forward_stats, args.rev_on_anomaly)):
+                check.append(j)
+            for k, v in values.items():
+                forward_stats[k].add(v)
+        rev_checked += len(check)
+
+        # batched metrics on the model's device, [N] each; reverse metrics are NaN (skipped) for unchecked slices
+        batch_metrics = {k: v.cpu().numpy() for k, v in evaluate(pred_for_mean, target_forward_patch).items()}
+        for k in REV_KEYS:
+            batch_metrics[k] = np.full(len(target_file_names), np.nan)
+
+        if check:
+            sel = torch.tensor(check, device=device)
+            synchronize(device)
+            model_time = time.time()
+            with torch.inference_mode():
+                reconstruct_rev = net(reconstruct_for[sel], rev=True)
+            synchronize(device)
+            model_time_sum += time.time() - model_time
+            pred_rev = torch.clamp(reconstruct_rev, 0, 1)
+
+            # rev_2 and rev_3 are the same slice in 1to1, evaluated once
+            pred_rev_2 = (pred_rev[:,0]+pred_rev[:,1])/2
+            target_rev_sel = target_rev_patch[sel]
+            psnr_rev = psnr(target_rev_sel.abs(), pred_rev_2.abs()).cpu().numpy()
+            ssim_rev = ssim(target_rev_sel.abs(), pred_rev_2.abs()).cpu().numpy()
+            batch_metrics['psnr_rev2'][check] = batch_metrics['psnr_rev3'][check] = psnr_rev
+            batch_metrics['ssim_rev2'][check] = batch_metrics['ssim_rev3'][check] = ssim_rev
+
+            pred_rev_2 = pred_rev_3 = pred_rev_2.cpu().numpy()
+            target_rev_2 = target_rev_3 = target_rev_sel.cpu().numpy()
+        stats.update(target_file_names, batch_metrics)
+
+        pred_for_mean = pred_for_mean.cpu().numpy()
+        target_forward_patch = target_forward_patch.cpu().numpy()
+
+        # handed to the writer pool, inference carries on while they drain
+        for j, target_file_name in enumerate(target_file_names):
+            input_file_name2, input_file_name3 = input_file_names2[j], input_file_names3[j]
+            files = {
+                'pred': (save_img, pred_for_mean[j], save_path+'/pred'+'/pred_'+target_file_name+'.png'),
+                'pred_mat': (save_mat, pred_for_mean[j], save_path+'/pred_mat'+'/pred_'+target_file_name+'.mat'),
+                'target': (save_img, target_forward_patch[j], save_path+'/target'+'/target_'+target_file_name+'.png'),
+            }
+            if j in check:
+                c = check.index(j)
+                files.update({
+                    'pred_rev_2': (save_img, pred_rev_2[c], save_path+'/pred_rev_2'+'/pred_rev_'+input_file_name2+'.png'),
+                    'pred_rev_3': (save_img, pred_rev_3[c], save_path+'/pred_rev_3'+'/pred_rev_'+input_file_name3+'.png'),
+                    'target_rev_2': (save_img, target_rev_2[c], save_path+'/target_rev_2'+'/target_rev_'+input_file_name2+'.png'),
+                    'target_rev_3': (save_img, target_rev_3[c], save_path+'/target_rev_3'+'/target_rev_'+input_file_name3+'.png'),
+                })
+            for d in outputs:
+                if d in files:
+                    writer.submit(*files[d])
         
-        TIME.append(times)
+        all_time += time.time()-step_time
 
         del reconstruct_for
-        del reconstruct_rev
         
-    ave_time = sum(TIME) / len(TIME)
-    all_time = sum(TIME)
+    flush_time = time.time()
+    written = writer.flush()
+    writer.close()
+    print("[INFO] Wrote {} files, waited {:.2f}s for the writers".format(written, time.time() - flush_time))
+    stats.close()
 
-    ave_psnr = sum(PSNR) / len(PSNR)
-    PSNR_std = np.std(PSNR)
-    
-    ave_psnr_rev2 = sum(PSNR_REV2) / len(PSNR_REV2)
-    PSNR_REV2_std = np.std(PSNR_REV2)
-    
-    ave_psnr_rev3 = sum(PSNR_REV3) / len(PSNR_REV3)
-    PSNR_REV3_std = np.std(PSNR_REV3)
-    
-    ave_ssim = sum(SSIM) / len(SSIM)
-    SSIM_std = np.std(SSIM)
-    
-    ave_ssim_rev2 = sum(SSIM_REV2) / len(SSIM_REV2)
-    SSIM_REV2_std = np.std(SSIM_REV2)
-    
-    ave_ssim_rev3 = sum(SSIM_REV3) / len(SSIM_REV3)
-    SSIM_REV3_std = np.std(SSIM_REV3)
-    
-    ave_mse = sum(MSE) / len(MSE)
-    
-    ave_nmse = sum(NMSE) / len(NMSE)
-    NMSE_std = np.std(NMSE)
-    
-    ave_rmse = sum(RMSE) / len(RMSE)
-    RMSE_std = np.std(RMSE)
-
-    print('ave_psnr',ave_psnr)
-    print('ave_psnr_rev2',ave_psnr_rev2)
-    print('ave_psnr_rev3',ave_psnr_rev3)
-    print('ave_ssim',ave_ssim)
-    print('ave_ssim_rev2',ave_ssim_rev2)
-    print('ave_ssim_rev3',ave_ssim_rev3)
-    print('ave_mse',ave_mse)
-    print('ave_nmse',ave_nmse)
-    print('ave_rmse',ave_rmse)
+    # model time excludes data loading, metrics and file writing
+    num = stats.summary()['psnr']['count']
+    ave_time = model_time_sum / num
+    slices_per_sec = num / model_time_sum
+    summary = stats.write_json(save_path+'/summary.json', ckpt=ckpt, num_slices=num, ave_time=ave_time,
+                               all_time=all_time, slices_per_sec=slices_per_sec,
+                               rev_checked=rev_checked)
+    print("[INFO] Reverse pass checked {}/{} slices".format(rev_checked, num))
+    print("[INFO] Per-slice metrics: {}  summary: {}".format(save_path+'/metrics.csv', save_path+'/summary.json'))
+    return summary
+
+
+def report(summary):
+    ckpt_allname = summary['ckpt'].split("/")[-1]
+    metrics = summary['metrics']
+
+    print('slices_per_sec',summary['slices_per_sec'])
+    for k in METRIC_KEYS:
+        print('ave_'+k, metrics[k]['mean'])
     
+    # the free-text log is kept for the existing records, summary.json is the machine-readable one
     with open('results_test.txt', 'a+') as f:
         f.write('\n'*3)
         f.write(ckpt_allname+'\n')
-        f.write('ave_time:'+str(ave_time)+' '*3+'all_time:'+str(all_time)+'\n')   
-        f.write('ave_psnr:'+str(ave_psnr)+' '*3+'PSNR_std:'+str(PSNR_std)+'\n')
-        f.write('ave_psnr_rev2:'+str(ave_psnr_rev2)+' '*3+'PSNR_REV2_std:'+str(PSNR_REV2_std)+'\n')
-        f.write('ave_psnr_rev3:'+str(ave_psnr_rev3)+' '*3+'PSNR_REV3_std:'+str(PSNR_REV3_std)+'\n')
-        f.write('ave_ssim:'+str(ave_ssim)+' '*3+'SSIM_std:'+str(SSIM_std)+'\n')
-        f.write('ave_ssim_rev2:'+str(ave_ssim_rev2)+' '*3+'SSIM_REV2_std:'+str(SSIM_REV2_std)+'\n')
-        f.write('ave_ssim_rev3:'+str(ave_ssim_rev3)+' '*3+'SSIM_REV3_std:'+str(SSIM_REV3_std)+'\n')
-        #f.write('ave_mse:'+str(ave_mse)+'\n')
-        f.write('ave_nmse:'+str(ave_nmse)+' '*3+'NMSE_std:'+str(NMSE_std)+'\n')
-        f.write('ave_rmse:'+str(ave_rmse)+' '*3+'RMSE_std:'+str(RMSE_std)+'\n')
+        f.write('ave_time:'+str(summary['ave_time'])+' '*3+'all_time:'+str(summary['all_time'])+' '*3+'slices_per_sec:'+str(summary['slices_per_sec'])+'\n')   
+        for k in METRIC_KEYS:
+            if k == 'mse':
+                continue
+            f.write('ave_'+k+':'+str(metrics[k]['mean'])+' '*3+k.upper()+'_std:'+str(metrics[k]['std'])+'\n')
+
+
+def rank(summaries, args):
+    """Ranked sweep table, written to <out_path>/sweep.csv and sweep.json."""
+    reverse = args.rank_by not in LOWER_IS_BETTER
+    summaries = sorted(summaries, key=lambda s: s['metrics'][args.rank_by]['mean'], reverse=reverse)
+    rows = [[i + 1, s['ckpt']] + [s['metrics'][k]['mean'] for k in METRIC_KEYS] for i, s in enumerate(summaries)]
+
+    with open(args.out_path+'/sweep.csv', 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(['rank', 'ckpt'] + METRIC_KEYS)
+        w.writerows(rows)
+    with open(args.out_path+'/sweep.json', 'w') as f:
+        json.dump({'rank_by': args.rank_by, 'checkpoints': summaries}, f, indent=2)
+
+    print("%4s  %-24s %10s %10s %10s" % ("rank", "ckpt", "psnr", "ssim", "nmse"))
+    for r in rows:
+        print("%4d  %-24s %10.4f %10.4f %10.4f" % (r[0], r[1].split("/")[-1], r[2], r[5], r[9]))
+    print("[INFO] Sweep table: {}".format(args.out_path+'/sweep.csv'))
+
+
+# sweep worker state, set once per process by init_worker
+WORKER = {}
+
+def init_worker(args, data, threads):
+    configure_threads(threads, args.num_interop_threads)
+    device = select_device(args.device)
+    WORKER.update(args=args, data=data, device=device, net=build_net(args, device))
+
+def sweep_worker(ckpt):
+    net = load_ckpt(WORKER['net'], ckpt, WORKER['args'].task)
+    return evaluate_ckpt(net, ckpt, WORKER['data'], WORKER['args'], WORKER['device'])
+
+
+def main(args):
+    if args.backend != 'eager':
+        # one exported artifact, no sweep
+        ckpts = [os.path.normpath(args.ckpt)]
+    else:
+        ckpts = list_checkpoints(args.ckpt)
+    if not ckpts:
+        raise FileNotFoundError("no checkpoints match {}".format(args.ckpt))
+    if args.task != '1to1':
+        raise ValueError("--task {} is not supported, only 1to1".format(args.task))
+    if args.rank_by not in METRIC_KEYS:
+        raise ValueError("--rank_by must be one of {}".format(METRIC_KEYS))
+
+    device = select_device(args.device)
+    print("[INFO] Device: {}  threads: {}/{}".format(device, torch.get_num_threads(), torch.get_num_interop_threads()))
+    
+    print("[INFO] Start data load and preprocessing") 
+    data = load_test_set(args)
+    print("[INFO] Decoded {} slices once for {} checkpoint(s)".format(data['input'].size(0), len(ckpts)))
+    
+    print("[INFO] Start test...")
+    if args.sweep_workers > 0 and len(ckpts) > 1:
+        # workers map the decoded slices from shared memory instead of copying them
+        data['input'].share_memory_()
+        data['target'].share_memory_()
+        threads = args.num_threads or max(1, torch.get_num_threads() // args.sweep_workers)
+        # pool workers are daemonic and cannot start writer processes: they write with threads
+        worker_args = argparse.Namespace(**vars(args))
+        worker_args.writer_processes = False
+        if args.writer_processes:
+            print("[INFO] --writer_processes is ignored with --sweep_workers, sweep workers write with threads")
+        ctx = mp.get_context('spawn')
+        with ctx.Pool(args.sweep_workers, initializer=init_worker, initargs=(worker_args, data, threads)) as pool:
+            summaries = pool.map(sweep_worker, ckpts, chunksize=1)
+    elif args.backend == 'torchscript':
+        net = ExportedNet(ckpts[0], device)
+        print("[INFO] Loaded exported graphs: {}".format(ckpts[0]))
+        summaries = [evaluate_ckpt(net, ckpts[0], data, args, device)]
+    elif args.backend == 'onnx':
+        from onnx_backend import OnnxNet
+        net = OnnxNet(ckpts[0], num_threads=args.num_threads)
+        print("[INFO] Loaded ONNX graphs: {}".format(ckpts[0]))
+        summaries = [evaluate_ckpt(net, ckpts[0], data, args, device)]
+    else:
+        net = build_net(args, device)
+        summaries = [evaluate_ckpt(load_ckpt(net, ckpt, args.task), ckpt, data, args, device) for ckpt in ckpts]
+
+    for summary in summaries:
+        report(summary)
+    if len(ckpts) > 1:
+        rank(summaries, args)
 
 
 if __name__ == '__main__':
-    torch.set_num_threads(4)
+    args = parser.parse_args()
+    print("Parsed arguments: {}".format(args))
+    configure_threads(args.num_threads, args.num_interop_threads)
     main(args)
-
@@ -1,5 +1,8 @@
 import os, time
 import json
+import math
+from functools import partial
+from contextlib import nullcontext
 import torch
 import numpy as np
 import torch.nn.functional as F
@@ -8,10 +11,15 @@ import torch.multiprocessing as mp
 from torch.utils.data import DataLoader, DistributedSampler
 from torch.optim import lr_scheduler
 from torch.nn.parallel import DistributedDataParallel as DDP
-from model.model import InvISPNet
+from model.model import InvISPNet, subnet, variable_augment
 from dataset.mri_dataset import mriDataset
+from dataset.resident import decode_all, ResidentLoader
 from config.config import get_arguments
 from tensorboardX import SummaryWriter
+from telemetry import Telemetry
+from checkpointing import AsyncCheckpointer, load_resume, gather_rng_states, strip_module
+from validation import BackgroundValidator, CheckpointRanking
+from utils import select_device, configure_threads
     
 def parse_arguments():
     parser = get_arguments()
@@ -19,9 +27,32 @@ def parse_arguments():
     parser.add_argument("--root1", type=str, default="./data/T2", help="Output images. ")
     parser.add_argument("--root2", type=str, default="./data/T1", help="Input images. ")
     parser.add_argument("--root3", type=str, default="./data/PD", help="Another input images. ")
-    parser.add_argument("--resume", dest='resume', action='store_true',  help="Resume training. ")
+    parser.add_argument("--resume", dest='resume', action='store_true',  help="Resume training from <out_path>/<task>/resume.pth (weights, optimizer, scheduler, epoch, step, RNG). ")
     parser.add_argument("--loss", type=str, default="L2", choices=["L1", "L2"], help="Choose which loss function to use. ")
     parser.add_argument("--lr", type=float, default=0.0001, help="Learning rate")
+    parser.add_argument("--epochs", type=int, default=300, help="Training epochs. ")
+    parser.add_argument("--invertible_backprop", dest='invertible_backprop', action='store_true', help="Rebuild block inputs from outputs in backward instead of storing activations. ")
+    parser.add_argument("--checkpoint", type=int, default=0, help="Gradient checkpointing: 0 = off, k = recompute every k blocks. ")
+    parser.add_argument("--memory_efficient", dest='memory_efficient', action='store_true', help="Grow DenseBlock features in one shared buffer instead of torch.cat. ")
+    parser.add_argument("--accum_steps", type=int, default=1, help="Micro-batches accumulated per optimizer step. ")
+    parser.add_argument("--lr_scaling", type=str, default="none", choices=["none", "linear", "sqrt"], help="Scale --lr with the effective batch (batch_size * accum_steps * world size) relative to --base_batch. ")
+    parser.add_argument("--base_batch", type=int, default=1, help="Effective batch size --lr was tuned for. ")
+    parser.add_argument("--resident", dest='resident', action='store_true', help="Decode the whole training set once onto the training device and batch by indexing (no DataLoader workers). ")
+    parser.add_argument("--log_interval", type=int, default=50, help="Steps between telemetry flushes to TensorBoard / stdout. ")
+    parser.add_argument("--sync_timing", dest='sync_timing', action='store_true', help="Synchronize the device at phase boundaries for exact per-phase GPU times. ")
+    parser.add_argument("--bf16", dest='bf16', action='store_true', help="Run the DenseBlock convs under bf16 autocast; coupling, 1x1 flow convs and loss stay float32. ")
+    parser.add_argument("--backend", type=str, default="auto", choices=["auto", "nccl", "gloo", "none"], help="auto: nccl under torchrun with GPUs, gloo under torchrun without, none (single process) otherwise. ")
+    parser.add_argument("--device", type=str, default="auto", help="Single-process device: auto (GPU if present, else CPU), cpu, cuda:0, ... ")
+    parser.add_argument("--num_threads", type=int, default=0, help="Intra-op CPU threads per process, 0 = 4 with GPUs, else the cores split over the local ranks. ")
+    parser.add_argument("--val_root1", type=str, default="", help="Held-out CT slices for validation during training, empty = no validation. ")
+    parser.add_argument("--val_root2", type=str, default="", help="Held-out PET slices. ")
+    parser.add_argument("--val_root3", type=str, default="", help="Held-out PET slices (root3). ")
+    parser.add_argument("--val_interval", type=int, default=1, help="Epochs between validations (the last epoch is always validated). ")
+    parser.add_argument("--val_batch_size", type=int, default=16)
+    parser.add_argument("--val_device", type=str, default="auto", help="Device of the validation process: auto (the training device of rank 0), cpu, cuda:1, ... ")
+    parser.add_argument("--val_threads", type=int, default=1, help="Intra-op CPU threads of the validation process. ")
+    parser.add_argument("--keep_top_k", type=int, default=5, help="With validation, keep only the k best numbered checkpoints (plus latest.pth), 0 = keep all. ")
+    parser.add_argument("--keep_by", type=str, default="psnr", choices=["psnr", "ssim"], help="Validation metric ranking the checkpoints. ")
     parser.add_argument('--local_rank', type=int, default=0)
     args = parser.parse_args()
     return args
@@ -33,96 +64,203 @@ def init_status(args):
     with open(args.out_path+"%s/commandline_args.yaml"%args.task , 'w') as f:
         json.dump(args.__dict__, f, indent=2)
     
-def setup():
-    """初始化分布式训练环境"""
-    dist.init_process_group("nccl", init_method="env://")  # NCCL 后端（最快）
+def select_backend(name='auto'):
+    # torchrun sets WORLD_SIZE; without it (or with a single rank) there is nothing to distribute
+    if name != 'auto':
+        return name
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return 'none'
+    return 'nccl' if torch.cuda.is_available() else 'gloo'
+
+def setup(args):
+    """初始化分布式训练环境，返回 (rank, world_size, device)"""
+    backend = select_backend(args.backend)
+    if backend == 'none':
+        # 单进程，不用 DDP
+        return 0, 1, select_device(args.device)
+
+    dist.init_process_group(backend, init_method="env://")  # NCCL（GPU，最快）或 Gloo（CPU）
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    if backend == 'nccl':
+        local_rank = int(os.environ.get('LOCAL_RANK', args.local_rank))
+        torch.cuda.set_device(local_rank)
+        return rank, world_size, torch.device('cuda', local_rank)
+    return rank, world_size, torch.device('cpu')
 
 def cleanup():
     """清理分布式环境"""
     if dist.is_initialized():
         dist.destroy_process_group()
 
-def main(world_size, args):
+def scaled_lr(lr, effective_batch, base_batch=1, rule='none'):
+    if rule == 'linear':
+        return lr * effective_batch / base_batch
+    if rule == 'sqrt':
+        return lr * math.sqrt(effective_batch / base_batch)
+    return lr
+
+def log_validation(result, ranking, writer):
+    if 'error' in result:
+        # ranked last, so it still counts against --keep_top_k
+        print("[WARN] validation of %s failed, ranked last: %s"%(result['ckpt'], result['error']))
+    else:
+        writer.add_scalar('val/psnr', result['psnr'], global_step=result['epoch'])
+        writer.add_scalar('val/ssim', result['ssim'], global_step=result['epoch'])
+        writer.add_scalar('val/nmse', result['nmse'], global_step=result['epoch'])
+        print("[INFO] Validation epoch: %d psnr: %.4f ssim: %.4f nmse: %.5f (%d slices)"%(
+            result['epoch'], result['psnr'], result['ssim'], result['nmse'], result['num_slices']))
+    for removed in ranking.add(result):
+        print("[INFO] Removed %s (not in the top %d by %s)"%(removed['ckpt'], ranking.k, ranking.key))
+
+def main(args):
     # 初始化 DDP
-    setup()
-    rank = dist.get_rank()
-    torch.cuda.set_device(rank % world_size)
-    device = torch.device(rank % world_size)
+    rank, world_size, device = setup(args)
+    distributed = world_size > 1 or dist.is_initialized()
+    if args.num_threads > 0:
+        configure_threads(args.num_threads)
+    elif device.type == 'cuda':
+        configure_threads(4)
+    else:
+        # CPU 训练：本机的核平均分给本机的各个 rank
+        configure_threads(max(1, (os.cpu_count() or 1) // int(os.environ.get('LOCAL_WORLD_SIZE', 1))))
+    if rank == 0:
+        init_status(args)
+        print("[INFO] Backend: {}  world size: {}  device: {}  threads: {}".format(
+            dist.get_backend() if dist.is_initialized() else 'none', world_size, device, torch.get_num_threads()))
     
     # 载入数据
     dataset = mriDataset(opt=args, root1=args.root1, root2=args.root2, root3=args.root3)
-    sampler = DistributedSampler(dataset, shuffle=True)
-    dataloader = DataLoader(
-        dataset, batch_size=1, num_workers=4, drop_last=True,
-        prefetch_factor=2, pin_memory=True, sampler=sampler
-    )
+    # rank / world size given explicitly, so the single-process mode needs no process group
+    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True)
+    if args.resident:
+        # 整个数据集常驻设备内存，按索引取 batch，sampler 只负责打乱和分片
+        data = decode_all(dataset, device)
+        print("[INFO] Resident dataset: {} slices, {:.1f} MB on {}".format(
+            len(dataset), 2 * data['input_img'].numel() * data['input_img'].element_size() / 2 ** 20, device))
+        dataloader = ResidentLoader(data, batch_size=args.batch_size, sampler=sampler, drop_last=True)
+    else:
+        dataloader = DataLoader(
+            dataset, batch_size=args.batch_size, num_workers=4, drop_last=True,
+            prefetch_factor=2, pin_memory=device.type == 'cuda', sampler=sampler
+        )
     
     # 定义模型
-    net = InvISPNet(channel_in=3, channel_out=3, block_num=8).to(device)
-    net = DDP(net)
+    net = InvISPNet(channel_in=3, channel_out=3, subnet_constructor=subnet('DBNet', memory_efficient=args.memory_efficient),
+                    block_num=8, invertible_backprop=args.invertible_backprop,
+                    checkpoint=args.checkpoint, bf16=args.bf16).to(device)
+
+    # 续训：rank 0 读取完整状态后广播给所有 rank
+    resume_path = args.out_path+"%s/resume.pth"%args.task
+    resume = load_resume(resume_path, rank) if args.resume else None
+    if resume is not None:
+        net.load_state_dict(resume['model'])
+        if rank == 0:
+            print("[INFO] loaded " + resume_path + " (epoch %d, step %d)"%(resume['epoch'], resume['step']))
+    elif args.resume and rank == 0:
+        # older runs only left the weights; DDP broadcasts them below
+        checkpoint_path = args.out_path+"%s/checkpoint/latest.pth"%args.task
+        net.load_state_dict(strip_module(torch.load(checkpoint_path, map_location=device)))
+        print("[INFO] loaded " + checkpoint_path)
 
-    if args.resume and rank == 0:
-        checkpoint_path = f"{args.out_path}/{args.task}/checkpoint/latest.pth"
-        net.load_state_dict(torch.load(checkpoint_path, map_location=device))
-        print("[INFO] loaded " + args.out_path+"%s/checkpoint/latest.pth"%args.task)
+    # loaded before wrapping: DDP broadcasts rank 0's weights to the other ranks
+    model = net
+    if distributed:
+        net = DDP(net, device_ids=[device.index] if device.type == 'cuda' else None)
         
     # 优化器和调度器
-    optimizer = torch.optim.Adam(net.parameters(), lr=args.lr)
+    # 学习率随有效 batch 缩放，MultiStepLR 的里程碑不变
+    effective_batch = args.batch_size * args.accum_steps * world_size
+    lr = scaled_lr(args.lr, effective_batch, args.base_batch, args.lr_scaling)
+    if rank == 0:
+        print("[INFO] Effective batch: {} ({} x {} accum x {} ranks), lr: {}".format(
+            effective_batch, args.batch_size, args.accum_steps, world_size, lr))
+    optimizer = torch.optim.Adam(net.parameters(), lr=lr)
     scheduler = lr_scheduler.MultiStepLR(optimizer, milestones=[10, 20, 30, 40, 50, 60, 70, 80, 90, 100, 150, 200, 250], gamma=0.5)
+    if resume is not None:
+        optimizer.load_state_dict(resume['optimizer'])
+        scheduler.load_state_dict(resume['scheduler'])
 
-    # 数据记录
-    writer = SummaryWriter(args.out_path+"%s"%args.task)
+    # 数据记录：只有 rank 0 写 TensorBoard，标量在设备上累加，每 log_interval 步同步一次
+    writer = SummaryWriter(args.out_path+"%s"%args.task) if rank == 0 else None
+    telemetry = Telemetry(writer, args.log_interval, device, args.sync_timing)
     
     # 初始化训练
     step = 0
-    loss_all = np.zeros((300), dtype='float')
+    start_epoch = 0
+    loss_all = np.zeros((args.epochs), dtype='float')
+    if resume is not None:
+        step = resume['step']
+        start_epoch = resume['epoch'] + 1
+        loss_all[:min(args.epochs, len(resume['loss_all']))] = resume['loss_all'][:args.epochs]
+    # 只有 rank 0 写 checkpoint，在后台线程里从 CPU 快照写出
+    checkpointer = AsyncCheckpointer() if rank == 0 else None
+    # 验证在独立进程里进行，训练不等待；只保留验证指标最好的 k 个 checkpoint
+    validator = None
+    if rank == 0 and args.val_root2:
+        validator = BackgroundValidator((args.val_root1, args.val_root2, args.val_root3), args.task, 8, args.val_batch_size,
+                                        device if args.val_device == 'auto' else args.val_device, args.val_threads)
+        ranking = CheckpointRanking(args.out_path+"%s/checkpoint/top_k.json"%args.task, args.keep_top_k, args.keep_by)
     num_batches = len(dataloader)
     
     print("[INFO] Start to train")
 
-    for epoch in range(0, 300):
+    for epoch in range(start_epoch, args.epochs):
         epoch_time = time.time()
-        loss_this_time = 0
+        # detached, on device: no graph is kept alive across the epoch
+        loss_this_time = torch.zeros((), device=device)
+        epoch_slices = 0
         dataloader.sampler.set_epoch(epoch)
-        for i_batch, sample_batched in enumerate(dataloader):
+        batches = iter(dataloader)
+        for i_batch in range(num_batches):
             step_time = time.time()
             
-            input = sample_batched['input_img'].to(device, non_blocking=True)
-            target_forward = sample_batched['target_forward_img'].to(device, non_blocking=True)
-            input_target = sample_batched['input_target_img'].to(device, non_blocking=True)
-            
-            # 向前传播
-            reconstruct_for = net(input)
-            reconstruct_for = torch.clamp(reconstruct_for, 0, 1)
-            forward_loss = F.l1_loss(reconstruct_for, target_forward)
-            # 反向传播
-            reconstruct_rev = net(reconstruct_for, rev=True)
-            reconstruct_rev = torch.clamp(reconstruct_rev, 0, 1)
-            rev_loss = F.l1_loss(reconstruct_rev, input_target)
-            
-            writer.add_scalar('forward_loss', forward_loss.item(), global_step=step)
-            writer.add_scalar('rev_loss', rev_loss.item(), global_step=step)
+            with telemetry.phase('data'):
+                sample_batched = next(batches)
+                # 单通道传输，在设备上扩展为3通道
+                input = variable_augment(sample_batched['input_img'].to(device, non_blocking=True))
+                target_forward = variable_augment(sample_batched['target_forward_img'].to(device, non_blocking=True))
+                input_target = input
             
-            loss = args.weight * forward_loss + rev_loss
-            writer.add_scalar('loss', loss.item(), global_step=step)
-            if rank == 0:
-                print('epoch: ' + str(epoch) + ' iter: ' + str(i_batch) +' loss: ' + str(loss.item()))
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            # 梯度累积：只在每个累积窗口的最后一个 micro-batch 做 allreduce 和 step。
+            # DDP 在 forward 时决定是否同步，所以 forward、reverse 和 backward 都要在 no_sync() 里
+            window_start = i_batch - i_batch % args.accum_steps
+            # 最后一个窗口可能不满 accum_steps 个 micro-batch
+            window = min(args.accum_steps, num_batches - window_start)
+            if i_batch == window_start:
+                optimizer.zero_grad()
+            sync = i_batch + 1 == window_start + window
+            with (nullcontext() if sync or not distributed else net.no_sync()):
+                # 向前传播
+                with telemetry.phase('forward'):
+                    reconstruct_for = net(input)
+                    reconstruct_for = torch.clamp(reconstruct_for, 0, 1)
+                    forward_loss = F.l1_loss(reconstruct_for, target_forward)
+                # 反向传播
+                with telemetry.phase('reverse'):
+                    reconstruct_rev = net(reconstruct_for, rev=True)
+                    reconstruct_rev = torch.clamp(reconstruct_rev, 0, 1)
+                    rev_loss = F.l1_loss(reconstruct_rev, input_target)
+                
+                loss = args.weight * forward_loss + rev_loss
+                telemetry.add(forward_loss=forward_loss, rev_loss=rev_loss, loss=loss)
+                
+                with telemetry.phase('backward'):
+                    (loss / window).backward()
+            if sync:
+                with telemetry.phase('step'):
+                    optimizer.step()
             
-            loss_this_time = loss_this_time + loss
+            loss_this_time += loss.detach()
+            epoch_slices += input.size(0)
             step += 1
+            logged = telemetry.step(step, input.size(0))
+            if logged is not None:
+                print("epoch: %d iter: %d loss: %.5f || ms/iter data %.1f forward %.1f reverse %.1f backward %.1f step %.1f" % (
+                    epoch, i_batch, logged['loss'], *(1000 * logged['times'][k] for k in Telemetry.PHASES)))
             
         loss_this_time = loss_this_time / num_batches
-        loss_all[epoch] = loss_this_time
+        loss_all[epoch] = loss_this_time.item()
         
-        torch.save(net.state_dict(), args.out_path+"%s/checkpoint/latest.pth"%args.task)
-        if epoch % 1 == 0 and rank == 0:
-            # os.makedirs(args.out_path+"%s/checkpoint/%04d"%(args.task,epoch), exist_ok=True)
-            torch.save(net.state_dict(), args.out_path+"%s/checkpoint/%04d.pth"%(args.task,epoch))
-            print("[INFO] Successfully saved "+args.out_path+"%s/checkpoint/%04d.pth"%(args.task,epoch))
-            
         if epoch % 10 == 0 and rank == 0:    
             print("task: %s Epoch: %d Step: %d || loss: %.5f rev_loss: %.10f forward_loss: %.5f  || lr: %f time: %f"%(
                 args.task, epoch, step, loss.detach().cpu().numpy(), rev_loss.detach().cpu().numpy(),
@@ -131,18 +269,50 @@ def main(world_size, args):
 
         scheduler.step()   
         
+        # every rank's RNG stream goes into the resume state (collective)
+        rng = gather_rng_states()
+        if rank == 0:
+            # the unwrapped model: same keys for every backend
+            weights = model.state_dict()
+            epoch_path = args.out_path+"%s/checkpoint/%04d.pth"%(args.task,epoch)
+            validate = validator is not None and ((epoch + 1) % args.val_interval == 0 or epoch + 1 == args.epochs)
+            files = {
+                args.out_path+"%s/checkpoint/latest.pth"%args.task: weights,
+                resume_path: {
+                    'model': weights, 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(),
+                    'epoch': epoch, 'step': step, 'loss_all': loss_all[:epoch + 1], 'rng': rng,
+                },
+            }
+            # with validation only the validated epochs get a numbered checkpoint, the ranking prunes them
+            if validator is None or validate:
+                files[epoch_path] = weights
+            checkpointer.save(files, on_saved=partial(validator.submit, epoch, epoch_path) if validate else None)
+            if validator is not None:
+                for result in validator.poll():
+                    log_validation(result, ranking, writer)
+        
+        # 所有 rank 合计的吞吐
+        slices_per_sec = epoch_slices * world_size / (time.time()-epoch_time)
         if rank == 0:
-            print("[INFO] Epoch time: ", time.time()-epoch_time, "task: ", args.task)    
+            writer.add_scalar('slices_per_sec', slices_per_sec, global_step=epoch)
+            writer.add_scalar('epoch_loss', loss_all[epoch], global_step=epoch)
+            print("[INFO] Epoch time: ", time.time()-epoch_time, "task: ", args.task, "slices/sec: ", slices_per_sec)    
     
     if rank == 0:
+        checkpointer.close()
+        if validator is not None:
+            for result in validator.close():
+                log_validation(result, ranking, writer)
+            best = ranking.best()
+            if best is not None:
+                print("[INFO] Best checkpoint by %s: %s (epoch %d, psnr %.4f ssim %.4f)"%(
+                    args.keep_by, best['ckpt'], best['epoch'], best['psnr'], best['ssim']))
         print("[INFO] Train finished.")
     cleanup()
 
 if __name__ == '__main__':
     try:
-        world_size = torch.cuda.device_count()
         args = parse_arguments()
-        torch.set_num_threads(4)
-        main(world_size, args)
+        main(args)
     finally:
         cleanup()
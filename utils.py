@@ -1,6 +1,89 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 import numpy as np
 import cv2
+import scipy.io as io
+import torch
 
 def save_img(img, img_path):
     img = np.clip(img*255,0,255)
-    cv2.imwrite(img_path, img)
\ No newline at end of file
+    cv2.imwrite(img_path, img)
+
+def save_mat(img, mat_path):
+    io.savemat(mat_path, {'img': img})
+
+# which result folders test.py writes
+OUTPUT_PROFILES = {
+    'full': ('pred', 'pred_mat', 'target', 'pred_rev_2', 'pred_rev_3', 'target_rev_2', 'target_rev_3'),
+    'pred': ('pred', 'pred_mat'),
+    'pred_mat': ('pred_mat',),
+    'none': (),
+}
+
+class AsyncWriter(object):
+    """
+    Background output stage: submit() hands a write to a thread (or process) pool
+    and only blocks once max_pending writes are queued; flush() waits for all of
+    them, re-raises the first failure and checks every file exists and is non-empty.
+    """
+    def __init__(self, workers=4, max_pending=64, processes=False):
+        pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self.pool = pool(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.max_pending = max_pending
+        self.futures = []
+        self.paths = []
+        self.error = None
+
+    def submit(self, fn, img, path):
+        self.slots.acquire()
+        future = self.pool.submit(fn, img, path)
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+        self.paths.append(path)
+        if len(self.futures) > 4 * self.max_pending:
+            self._collect(wait=False)
+
+    def _collect(self, wait):
+        pending = []
+        for future in self.futures:
+            if not wait and not future.done():
+                pending.append(future)
+            elif future.exception() is not None and self.error is None:
+                self.error = future.exception()
+        self.futures = pending
+
+    def flush(self):
+        self._collect(wait=True)
+        paths, self.paths = self.paths, []
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        missing = [p for p in paths if not os.path.isfile(p) or os.path.getsize(p) == 0]
+        if missing:
+            raise IOError("%d outputs were not written, e.g. %s" % (len(missing), missing[0]))
+        return len(paths)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+def select_device(name='auto'):
+    # 'auto': first GPU if there is one, otherwise CPU
+    if name == 'auto':
+        name = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    return torch.device(name)
+
+def configure_threads(num_threads=0, num_interop_threads=0):
+    # 0 keeps the torch default (all physical cores); call before any parallel work
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads > 0:
+        torch.set_num_interop_threads(num_interop_threads)
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+def synchronize(device):
+    # wait for queued kernels so wall-clock timings cover the model only
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
\ No newline at end of file
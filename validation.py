@@ -0,0 +1,137 @@
+import os
+import json
+import queue
+import argparse
+
+import torch
+import torch.multiprocessing as mp
+
+from model.model import InvISPNet, subnet, variable_augment
+from dataset.mri_dataset import mriDataset
+from dataset.resident import decode_all
+from checkpointing import load_checkpoint
+from metrics import evaluate
+from utils import select_device, configure_threads
+
+
+# Validation during training: a side process keeps the held-out slices decoded on its
+# device and scores every checkpoint train_lr.py hands it, so the training loop never
+# waits for it. Results come back through a queue and drive the top-k retention.
+
+VAL_KEYS = ('psnr', 'ssim', 'nmse')
+
+
+def validate(net, data, batch_size, device):
+    """Mean forward (PET -> CT) metrics of net over the cached validation tensors."""
+    sums = dict.fromkeys(VAL_KEYS, 0.)
+    num = data['input_img'].size(0)
+    with torch.inference_mode():
+        for start in range(0, num, batch_size):
+            input = data['input_img'][start:start + batch_size].to(device)
+            target = data['target_forward_img'][start:start + batch_size].to(device)
+            pred = torch.clamp(net(variable_augment(input)), 0, 1).mean(1)
+            metrics = evaluate(pred, target[:, 0])
+            for k in VAL_KEYS:
+                sums[k] += metrics[k].sum().item()
+    return {k: v / num for k, v in sums.items()}
+
+
+def _worker(jobs, results, roots, task, block_num, batch_size, device, num_threads):
+    configure_threads(num_threads)
+    device = select_device(device)
+    dataset = mriDataset(opt=argparse.Namespace(task=task, store=None), root1=roots[0], root2=roots[1], root3=roots[2])
+    data = decode_all(dataset, device)
+    net = InvISPNet(channel_in=3, channel_out=3, subnet_constructor=subnet('DBNet'), block_num=block_num).to(device).eval()
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        epoch, ckpt = job
+        try:
+            load_checkpoint(net, ckpt, block_num=block_num)
+            result = validate(net, data, batch_size, device)
+        except Exception as e:
+            result = {'error': repr(e)}
+        result.update(epoch=epoch, ckpt=ckpt, num_slices=len(dataset))
+        results.put(result)
+    results.put(None)
+
+
+class BackgroundValidator(object):
+    """
+    Spawned validation process fed through a queue: submit() (safe from the checkpoint
+    writer thread) queues a saved checkpoint, poll() returns the results that are in
+    without waiting, close() waits for the remaining ones and stops the process.
+    """
+    def __init__(self, roots, task='1to1', block_num=8, batch_size=16, device='cpu', num_threads=1):
+        ctx = mp.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=_worker, daemon=True,
+                                   args=(self.jobs, self.results, roots, task, block_num, batch_size, str(device), num_threads))
+        self.process.start()
+
+    def submit(self, epoch, ckpt):
+        self.jobs.put((epoch, ckpt))
+
+    def poll(self):
+        done = []
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                return done
+            if result is not None:
+                done.append(result)
+
+    def close(self):
+        self.jobs.put(None)
+        done = []
+        while True:
+            try:
+                result = self.results.get(timeout=5)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    break
+                continue
+            if result is None:
+                break
+            done.append(result)
+        self.process.join()
+        return done
+
+
+class CheckpointRanking(object):
+    """
+    Top-k retention of the numbered checkpoints by a validation metric (higher is better):
+    add() ranks a validated checkpoint and deletes the ones that fall out of the top k
+    (k = 0 keeps all). A failed validation (no metrics) ranks last, so it is the first
+    to go. The ranking is kept in a json file, so a resumed run continues it.
+    """
+    def __init__(self, path, k=5, key='psnr'):
+        self.path = path
+        self.k = k
+        self.key = key
+        self.entries = []
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def add(self, result):
+        self.entries.append(result)
+        self.entries.sort(key=lambda e: e.get(self.key, float('-inf')), reverse=True)
+        removed = []
+        if self.k > 0:
+            removed, self.entries = self.entries[self.k:], self.entries[:self.k]
+            for e in removed:
+                if os.path.isfile(e['ckpt']):
+                    os.remove(e['ckpt'])
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp, self.path)
+        return removed
+
+    def best(self):
+        scored = [e for e in self.entries if self.key in e]
+        return scored[0] if scored else None